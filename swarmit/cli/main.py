@@ -1,31 +1,35 @@
 #!/usr/bin/env python
 
+import dataclasses
+import hashlib
 import time
 
 import click
-from dotbot_utils.serial_interface import (
-    get_default_port,
-)
-from rich import print
 from rich.console import Console
 from rich.pretty import pprint
 
 from swarmit import __version__
+from swarmit.testbed.adapter import AdapterInitError
 from swarmit.testbed.controller import (
     CHUNK_SIZE,
     OTA_ACK_TIMEOUT_DEFAULT,
     OTA_MAX_RETRIES_DEFAULT,
+    OTA_WINDOW_DEFAULT,
     Controller,
     ControllerSettings,
     ResetLocation,
+    build_controller_settings,
     print_transfer_status,
 )
-from swarmit.testbed.helpers import load_toml_config
+from swarmit.testbed.helpers import load_toml_config, merge_config
 from swarmit.testbed.logger import setup_logging
 
+CONSOLE = Console()
+
 DEFAULTS = {
     "adapter": "edge",
-    "serial_port": get_default_port(),
+    # Detected when needed, see default_serial_port()
+    "serial_port": None,
     "baudrate": 1000000,
     "mqtt_host": "localhost",
     "mqtt_port": 1883,
@@ -37,6 +41,15 @@ DEFAULTS = {
 }
 
 
+def create_controller(settings: ControllerSettings) -> Controller:
+    """Create the controller, abort if the gateway adapter can't be initialized."""
+    try:
+        return Controller(settings)
+    except AdapterInitError as exc:
+        CONSOLE.print(f"[bold red]Error:[/] {exc}")
+        raise click.Abort()
+
+
 @click.group(context_settings=dict(help_option_names=["-h", "--help"]))
 @click.option(
     "-c",
@@ -48,7 +61,7 @@ DEFAULTS = {
     "-p",
     "--port",
     type=str,
-    help=f"Serial port to use to send the bitstream to the gateway. Default: {DEFAULTS['serial_port']}.",
+    help="Serial port to use to send the bitstream to the gateway. Default: first J-Link port found or /dev/ttyACM0.",
 )
 @click.option(
     "-b",
@@ -127,37 +140,22 @@ def main(
         "verbose": verbose,
     }
 
-    # Merge in order of priority: CLI > config > defaults
-    final_config = {
-        **DEFAULTS,
-        **{k: v for k, v in config_data.items() if v is not None},
-        **{k: v for k, v in cli_args.items() if v not in (None, False)},
-    }
+    final_config = merge_config(DEFAULTS, config_data, cli_args)
 
     setup_logging()
     ctx.ensure_object(dict)
-    ctx.obj["settings"] = ControllerSettings(
-        serial_port=final_config["serial_port"],
-        serial_baudrate=final_config["baudrate"],
-        mqtt_host=final_config["mqtt_host"],
-        mqtt_port=final_config["mqtt_port"],
-        mqtt_use_tls=final_config["mqtt_use_tls"],
-        network_id=int(final_config["swarmit_network_id"], 16),
-        adapter=final_config["adapter"],
-        devices=[d for d in final_config["devices"].split(",") if d],
-        verbose=final_config["verbose"],
-    )
+    ctx.obj["settings"] = build_controller_settings(final_config)
 
 
 @main.command()
 @click.pass_context
 def start(ctx):
     """Start the user application."""
-    controller = Controller(ctx.obj["settings"])
+    controller = create_controller(ctx.obj["settings"])
     if controller.ready_devices:
         controller.start()
     else:
-        print("No device to start")
+        CONSOLE.print("No device to start")
     controller.terminate()
 
 
@@ -165,11 +163,11 @@ def start(ctx):
 @click.pass_context
 def stop(ctx):
     """Stop the user application."""
-    controller = Controller(ctx.obj["settings"])
+    controller = create_controller(ctx.obj["settings"])
     if controller.running_devices or controller.resetting_devices:
         controller.stop()
     else:
-        print("[bold]No device to stop[/]")
+        CONSOLE.print("[bold]No device to stop[/]")
     controller.terminate()
 
 
@@ -184,29 +182,30 @@ def reset(ctx, locations):
 
     Locations are provided as '<device_addr>:<x>,<y>-<device_addr>:<x>,<y>|...'
     """
-    controller = Controller(ctx.obj["settings"])
+    controller = create_controller(ctx.obj["settings"])
     devices = controller.settings.devices
-    print(devices)
+    CONSOLE.print(devices)
     if not devices:
-        print("No device selected.")
+        CONSOLE.print("No device selected.")
         controller.terminate()
         return
-    locations = {
-        int(location.split(":")[0], 16): ResetLocation(
-            pos_x=int(float(location.split(":")[1].split(",")[0])),
-            pos_y=int(float(location.split(":")[1].split(",")[1])),
+    reset_locations = {}
+    for location in locations.split("-"):
+        addr, position = location.split(":", 1)
+        pos_x, pos_y = position.split(",", 1)
+        # Same address format as the selected devices
+        reset_locations[f"{int(addr, 16):08X}"] = ResetLocation(
+            pos_x=int(float(pos_x)), pos_y=int(float(pos_y))
         )
-        for location in locations.split("-")
-    }
-    if sorted(devices) and sorted(locations.keys()) != sorted(devices):
-        print("Selected devices and reset locations do not match.")
+    if set(reset_locations) != set(devices):
+        CONSOLE.print("Selected devices and reset locations do not match.")
         controller.terminate()
         return
     if not controller.ready_devices:
-        print("No device to reset.")
+        CONSOLE.print("No device to reset.")
         controller.terminate()
         return
-    controller.reset(locations)
+    controller.reset(reset_locations)
     controller.terminate()
 
 
@@ -239,38 +238,50 @@ def reset(ctx, locations):
     show_default=True,
     help="Number of retries for each OTA message (start or chunk) transfer.",
 )
+@click.option(
+    "--ota-window",
+    type=click.IntRange(min=1),
+    default=OTA_WINDOW_DEFAULT,
+    show_default=True,
+    help="Number of OTA chunks sent without waiting for their acknowledgment.",
+)
 @click.argument("firmware", type=click.File(mode="rb"), required=False)
 @click.pass_context
-def flash(ctx, yes, start, ota_timeout, ota_max_retries, firmware):
+def flash(ctx, yes, start, ota_timeout, ota_max_retries, ota_window, firmware):
     """Flash a firmware to the robots."""
-    console = Console()
     if firmware is None:
-        console.print("[bold red]Error:[/] Missing firmware file. Exiting.")
+        CONSOLE.print("[bold red]Error:[/] Missing firmware file. Exiting.")
         raise click.Abort()
 
-    ctx.obj["settings"].ota_timeout = ota_timeout
-    ctx.obj["settings"].ota_max_retries = ota_max_retries
-    fw = bytearray(firmware.read())
-    controller = Controller(ctx.obj["settings"])
+    settings = dataclasses.replace(
+        ctx.obj["settings"],
+        ota_timeout=ota_timeout,
+        ota_max_retries=ota_max_retries,
+        ota_window=ota_window,
+    )
+    fw = memoryview(firmware.read())
+    fw_hash = hashlib.sha256(fw).digest()
+    controller = create_controller(settings)
     if not controller.ready_devices:
-        console.print("[bold red]Error:[/] No ready device found. Exiting.")
+        CONSOLE.print("[bold red]Error:[/] No ready device found. Exiting.")
         controller.terminate()
         raise click.Abort()
 
-    print(
+    CONSOLE.print(
         f"Devices to flash ([bold white]{len(controller.ready_devices)}):[/]"
     )
-    pprint(controller.ready_devices, expand_all=True)
+    pprint(controller.ready_devices, console=CONSOLE, expand_all=True)
     if yes is False:
         click.confirm("Do you want to continue?", default=True, abort=True)
 
-    start_data = controller.start_ota(fw)
+    start_data = controller.start_ota(fw, fw_hash=fw_hash)
     if controller.settings.verbose:
-        print("\n[b]Start OTA response:[/]")
-        pprint(start_data, indent_guides=False, expand_all=True)
+        CONSOLE.print("\n[b]Start OTA response:[/]")
+        pprint(
+            start_data, console=CONSOLE, indent_guides=False, expand_all=True
+        )
     if start_data["missed"]:
-        console = Console()
-        console.print(
+        CONSOLE.print(
             f"[bold red]Error:[/] {len(start_data['missed'])} acknowledgments "
             f"are missing ({', '.join(sorted(set(start_data['missed'])))}). "
             "Aborting."
@@ -279,25 +290,26 @@ def flash(ctx, yes, start, ota_timeout, ota_max_retries, firmware):
         controller.terminate()
         raise click.Abort()
 
-    print()
-    print(f"Image size: [bold cyan]{len(fw)}B[/]")
-    print(
+    CONSOLE.print()
+    CONSOLE.print(f"Image size: [bold cyan]{len(fw)}B[/]")
+    CONSOLE.print(
         f"Image hash: [bold cyan]{start_data['ota'].fw_hash.hex().upper()}[/]"
     )
-    print(
+    CONSOLE.print(
         f"Radio chunks ([bold]{CHUNK_SIZE}B[/bold]): {start_data['ota'].chunks}"
     )
     start_time = time.time()
     data = controller.transfer(fw, start_data["acked"])
-    print(f"Elapsed: [bold cyan]{time.time() - start_time:.3f}s[/bold cyan]")
+    CONSOLE.print(
+        f"Elapsed: [bold cyan]{time.time() - start_time:.3f}s[/bold cyan]"
+    )
     print_transfer_status(data, start_data["ota"])
     if controller.settings.verbose:
-        print("\n[b]Transfer data:[/]")
-        pprint(data, indent_guides=False, expand_all=True)
+        CONSOLE.print("\n[b]Transfer data:[/]")
+        pprint(data, console=CONSOLE, indent_guides=False, expand_all=True)
     if all([device.success for device in data.values()]) is False:
         controller.terminate()
-        console = Console()
-        console.print("[bold red]Error:[/] Transfer failed.")
+        CONSOLE.print("[bold red]Error:[/] Transfer failed.")
         raise click.Abort()
 
     if start is True:
@@ -311,11 +323,11 @@ def flash(ctx, yes, start, ota_timeout, ota_max_retries, firmware):
 @click.pass_context
 def monitor(ctx):
     """Monitor running applications."""
+    controller = create_controller(ctx.obj["settings"])
     try:
-        controller = Controller(ctx.obj["settings"])
         controller.monitor()
     except KeyboardInterrupt:
-        print("Stopping monitor.")
+        CONSOLE.print("Stopping monitor.")
     finally:
         controller.terminate()
 
@@ -330,7 +342,7 @@ def monitor(ctx):
 @click.pass_context
 def status(ctx, watch):
     """Print current status of the robots."""
-    controller = Controller(ctx.obj["settings"])
+    controller = create_controller(ctx.obj["settings"])
     controller.status(watch=watch)
     controller.terminate()
 
@@ -340,7 +352,7 @@ def status(ctx, watch):
 @click.pass_context
 def message(ctx, message):
     """Send a custom text message to the robots."""
-    controller = Controller(ctx.obj["settings"])
+    controller = create_controller(ctx.obj["settings"])
     controller.send_message(message)
     controller.terminate()
 
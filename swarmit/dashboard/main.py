@@ -7,10 +7,17 @@ import uvicorn
 
 from swarmit import __version__
 from swarmit.cli.main import DEFAULTS
-from swarmit.testbed.controller import ControllerSettings
-from swarmit.testbed.helpers import load_toml_config
+from swarmit.testbed.controller import (
+    ControllerSettings,
+    build_controller_settings,
+)
+from swarmit.testbed.helpers import load_toml_config, merge_config
 from swarmit.testbed.webserver import api, init_api, mount_frontend
 
+# Server readiness checks done before opening the web browser
+BROWSER_POLL_DELAY = 0.02
+BROWSER_POLL_TIMEOUT = 30
+
 DEFAULTS_DASHBOARD = {
     **DEFAULTS,
     "http_port": 8001,
@@ -29,7 +36,7 @@ DEFAULTS_DASHBOARD = {
     "-p",
     "--port",
     type=str,
-    help=f"Serial port to use to send the bitstream to the gateway. Default: {DEFAULTS_DASHBOARD['serial_port']}.",
+    help="Serial port to use to send the bitstream to the gateway. Default: first J-Link port found or /dev/ttyACM0.",
 )
 @click.option(
     "-b",
@@ -128,24 +135,10 @@ def main(
         "http_port": http_port,
     }
 
-    # Merge in order of priority: CLI > config > defaults
-    final_config = {
-        **DEFAULTS_DASHBOARD,
-        **{k: v for k, v in config_data.items() if v is not None},
-        **{k: v for k, v in cli_args.items() if v not in (None, False)},
-    }
+    final_config = merge_config(DEFAULTS_DASHBOARD, config_data, cli_args)
 
-    controller_settings = ControllerSettings(
-        serial_port=final_config["serial_port"],
-        serial_baudrate=final_config["baudrate"],
-        mqtt_host=final_config["mqtt_host"],
-        mqtt_port=final_config["mqtt_port"],
-        mqtt_use_tls=final_config["mqtt_use_tls"],
-        network_id=int(final_config["swarmit_network_id"], 16),
-        adapter=final_config["adapter"],
-        devices=[d for d in final_config["devices"].split(",") if d],
-        map_size=final_config["map_size"],
-        verbose=final_config["verbose"],
+    controller_settings = build_controller_settings(
+        final_config, map_size=final_config["map_size"]
     )
 
     asyncio.run(
@@ -190,10 +183,18 @@ async def async_web(
 
 async def _serve_fast_api(settings: ControllerSettings, http_port: int):
     """Starts the web server application."""
-    init_api(api, settings)
-    mount_frontend(api)
+    # Controller creation can block on the gateway adapter, don't block the
+    # event loop meanwhile
+    await asyncio.gather(
+        asyncio.to_thread(init_api, api, settings),
+        asyncio.to_thread(mount_frontend, api),
+    )
     config = uvicorn.Config(
-        api, host="0.0.0.0", port=http_port, log_level="info"
+        api,
+        host="0.0.0.0",
+        port=http_port,
+        log_level="info",
+        access_log=False,
     )
     server = uvicorn.Server(config)
 
@@ -210,11 +211,16 @@ async def _serve_fast_api(settings: ControllerSettings, http_port: int):
 
 async def _open_webbrowser(http_port: int):
     """Wait until the server is ready before opening a web browser."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + BROWSER_POLL_TIMEOUT
     while True:
         try:
             _, writer = await asyncio.open_connection("127.0.0.1", http_port)
         except ConnectionRefusedError:
-            await asyncio.sleep(0.1)
+            if loop.time() >= deadline:
+                print("Web server not reachable, not opening webbrowser")
+                return
+            await asyncio.sleep(BROWSER_POLL_DELAY)
         else:
             writer.close()
             break
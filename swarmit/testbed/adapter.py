@@ -1,10 +1,10 @@
 """Module containing classes for interfacing with the DotBot gateway."""
 
-import sys
-import time
+import threading
 from abc import ABC, abstractmethod
 
 from dotbot_utils.protocol import (
+    PAYLOAD_PARSERS,
     Packet,
     Payload,
     ProtocolPayloadParserException,
@@ -17,6 +17,39 @@ from marilib.marilib_edge import MarilibEdge
 from marilib.model import EdgeEvent, MariNode
 from rich import print
 
+from swarmit.testbed.protocol import PARSER_TABLE
+
+MARI_UPDATE_PERIOD = 0.5  # s
+
+
+class AdapterInitError(Exception):
+    """Exception raised when an adapter cannot be initialized."""
+
+
+def parse_packet(payload: bytes, verbose: bool = False) -> Packet | None:
+    """Parse a received payload, return None if it's invalid."""
+    # Check the payload type first to skip unsupported frames cheaply
+    parser = PARSER_TABLE[payload[0]] if payload else None
+    if parser is None and payload:
+        # Parsers registered after the table was built
+        parser = PAYLOAD_PARSERS.get(payload[0])
+    if parser is None:
+        if verbose:
+            payload_type = f"0x{payload[0]:02X}" if payload else "missing"
+            print(
+                "[red]Error parsing packet: "
+                f"Unsupported payload type '{payload_type}'[/]"
+            )
+        return None
+    try:
+        return Packet(
+            payload_type=payload[0], payload=parser().from_bytes(payload[1:])
+        )
+    except (ValueError, ProtocolPayloadParserException) as exc:
+        if verbose:
+            print(f"[red]Error parsing packet: {exc}[/]")
+        return None
+
 
 class GatewayAdapterBase(ABC):
     """Base class for interface adapters."""
@@ -30,8 +63,12 @@ class GatewayAdapterBase(ABC):
         """Close the interface."""
 
     @abstractmethod
+    def send_bytes(self, destination: int, data: bytes):
+        """Send an already serialized packet to the interface."""
+
     def send_payload(self, destination: int, payload: Payload):
         """Send payload to the interface."""
+        self.send_bytes(destination, Packet.from_payload(payload).to_bytes())
 
 
 class MarilibEdgeAdapter(GatewayAdapterBase):
@@ -39,20 +76,18 @@ class MarilibEdgeAdapter(GatewayAdapterBase):
 
     def on_event(self, event: EdgeEvent, event_data: MariNode | MariFrame):
         if event == EdgeEvent.NODE_JOINED:
+            self._node_joined.set()
             if self.verbose:
                 print("[green]Node joined:[/]", event_data)
         elif event == EdgeEvent.NODE_LEFT:
             if self.verbose:
                 print("[orange]Node left:[/]", event_data)
         elif event == EdgeEvent.NODE_DATA:
-            try:
-                packet = Packet.from_bytes(event_data.payload)
-            except (ValueError, ProtocolPayloadParserException) as exc:
-                if self.verbose:
-                    print(f"[red]Error parsing packet: {exc}[/]")
-                return
             if not hasattr(self, "on_frame_received"):
                 return
+            packet = parse_packet(event_data.payload, self.verbose)
+            if packet is None:
+                return
             self.on_frame_received(event_data.header, packet)
 
     def __init__(
@@ -64,6 +99,11 @@ class MarilibEdgeAdapter(GatewayAdapterBase):
     ):
         self.verbose = verbose
         self.busy_wait_timeout = busy_wait_timeout
+        self._node_joined = threading.Event()
+        self._stop_event = threading.Event()
+        self._update_thread = threading.Thread(
+            target=self._update_loop, daemon=True
+        )
         try:
             self.mari = MarilibEdge(
                 self.on_event,
@@ -71,15 +111,24 @@ class MarilibEdgeAdapter(GatewayAdapterBase):
                 metrics_probe_period=0,
             )
         except Exception as exc:
-            print(f"[red]Error initializing MarilibEdge: {exc}[/]")
-            sys.exit(1)
+            raise AdapterInitError(
+                f"Error initializing MarilibEdge: {exc}"
+            ) from exc
+        self._update_thread.start()
+
+    def _update_loop(self):
+        """Run Marilib periodic bookkeeping until the adapter is closed."""
+        while not self._stop_event.wait(MARI_UPDATE_PERIOD):
+            self.mari.update()
+
+    def _stop_update_thread(self):
+        self._stop_event.set()
+        if self._update_thread.is_alive():
+            self._update_thread.join()
 
     def _busy_wait(self):
-        """Wait for the condition to be met."""
-        while self.busy_wait_timeout > 0:
-            self.mari.update()
-            self.busy_wait_timeout -= 0.1
-            time.sleep(0.1)
+        """Wait until a node joins or the timeout expires."""
+        self._node_joined.wait(self.busy_wait_timeout)
 
     def init(self, on_frame_received: callable):
         self.on_frame_received = on_frame_received
@@ -89,13 +138,11 @@ class MarilibEdgeAdapter(GatewayAdapterBase):
             print(self.mari.nodes)
 
     def close(self):
+        self._stop_update_thread()
         self.mari.serial_interface.close()
 
-    def send_payload(self, destination: int, payload: Payload):
-        self.mari.send_frame(
-            dst=destination,
-            payload=Packet.from_payload(payload).to_bytes(),
-        )
+    def send_bytes(self, destination: int, data: bytes):
+        self.mari.send_frame(dst=destination, payload=data)
 
 
 class MarilibCloudAdapter(GatewayAdapterBase):
@@ -103,20 +150,18 @@ class MarilibCloudAdapter(GatewayAdapterBase):
 
     def on_event(self, event: EdgeEvent, event_data: MariNode | MariFrame):
         if event == EdgeEvent.NODE_JOINED:
+            self._node_joined.set()
             if self.verbose:
                 print("[green]Node joined:[/]", event_data)
         elif event == EdgeEvent.NODE_LEFT:
             if self.verbose:
                 print("[orange]Node left:[/]", event_data)
         elif event == EdgeEvent.NODE_DATA:
-            try:
-                packet = Packet.from_bytes(event_data.payload)
-            except (ValueError, ProtocolPayloadParserException) as exc:
-                if self.verbose:
-                    print(f"[red]Error parsing packet: {exc}[/]")
-                return
             if not hasattr(self, "on_frame_received"):
                 return
+            packet = parse_packet(event_data.payload, self.verbose)
+            if packet is None:
+                return
             self.on_frame_received(event_data.header, packet)
 
     def __init__(
@@ -130,6 +175,11 @@ class MarilibCloudAdapter(GatewayAdapterBase):
     ):
         self.verbose = verbose
         self.busy_wait_timeout = busy_wait_timeout
+        self._node_joined = threading.Event()
+        self._stop_event = threading.Event()
+        self._update_thread = threading.Thread(
+            target=self._update_loop, daemon=True
+        )
         try:
             self.mari = MarilibCloud(
                 self.on_event,
@@ -137,15 +187,24 @@ class MarilibCloudAdapter(GatewayAdapterBase):
                 network_id,
             )
         except Exception as exc:
-            print(f"[red]Error initializing MarilibCloud: {exc}[/]")
-            sys.exit(1)
+            raise AdapterInitError(
+                f"Error initializing MarilibCloud: {exc}"
+            ) from exc
+        self._update_thread.start()
+
+    def _update_loop(self):
+        """Run Marilib periodic bookkeeping until the adapter is closed."""
+        while not self._stop_event.wait(MARI_UPDATE_PERIOD):
+            self.mari.update()
+
+    def _stop_update_thread(self):
+        self._stop_event.set()
+        if self._update_thread.is_alive():
+            self._update_thread.join()
 
     def _busy_wait(self):
-        """Wait for the condition to be met."""
-        while self.busy_wait_timeout > 0:
-            self.mari.update()
-            self.busy_wait_timeout -= 0.1
-            time.sleep(0.1)
+        """Wait until a node joins or the timeout expires."""
+        self._node_joined.wait(self.busy_wait_timeout)
 
     def init(self, on_frame_received: callable):
         self.on_frame_received = on_frame_received
@@ -155,10 +214,7 @@ class MarilibCloudAdapter(GatewayAdapterBase):
             print(self.mari.nodes)
 
     def close(self):
-        pass
+        self._stop_update_thread()
 
-    def send_payload(self, destination: int, payload: Payload):
-        self.mari.send_frame(
-            dst=destination,
-            payload=Packet.from_payload(payload).to_bytes(),
-        )
+    def send_bytes(self, destination: int, data: bytes):
+        self.mari.send_frame(dst=destination, payload=data)
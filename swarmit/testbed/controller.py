@@ -4,11 +4,11 @@ import dataclasses
 import threading
 import time
 from binascii import hexlify
+from collections import deque
 from dataclasses import dataclass
 
 from cryptography.hazmat.primitives import hashes
 from dotbot_utils.protocol import Packet, Payload
-from dotbot_utils.serial_interface import get_default_port
 from rich import print
 from rich.console import Group
 from rich.live import Live
@@ -17,10 +17,12 @@ from rich.text import Text
 from tqdm import tqdm
 
 from swarmit.testbed.adapter import (
+    AdapterInitError,
     GatewayAdapterBase,
     MarilibCloudAdapter,
     MarilibEdgeAdapter,
 )
+from swarmit.testbed.helpers import default_serial_port
 from swarmit.testbed.logger import LOGGER
 from swarmit.testbed.protocol import (
     DeviceType,
@@ -43,10 +45,12 @@ STATUS_TIMEOUT = 5
 MONITOR_TIMEOUT = 60  # s
 OTA_MAX_RETRIES_DEFAULT = 10
 OTA_ACK_TIMEOUT_DEFAULT = 0.7
-SERIAL_PORT_DEFAULT = get_default_port()
+OTA_WINDOW_DEFAULT = 1
 BROADCAST_ADDRESS = 0xFFFFFFFFFFFFFFFF
 VOLTAGE_MAX = 3000  # mV
 VOLTAGE_WARNING = 1500  # mV
+ADAPTER_INIT_MAX_ATTEMPTS = 3
+ADAPTER_INIT_RETRY_DELAY = 0.5  # s, doubled after each failed attempt
 
 
 @dataclass
@@ -58,7 +62,8 @@ class NodeStatus:
     battery: int = 0
     pos_x: int = 0
     pos_y: int = 0
-    last_updated_at: float = 0
+    # Only used to detect inactive nodes, not part of the reported status
+    last_updated_at: float = dataclasses.field(default=0, compare=False)
 
 
 @dataclass
@@ -202,24 +207,51 @@ def wait_for_done(timeout):
     return False
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ControllerSettings:
-    """Class that holds controller settings."""
+    """Class that holds controller settings.
+
+    Settings are immutable, use dataclasses.replace() to derive new ones.
+    """
 
-    serial_port: str = SERIAL_PORT_DEFAULT
+    serial_port: str = dataclasses.field(default_factory=default_serial_port)
     serial_baudrate: int = 1000000
     mqtt_host: str = "localhost"
     mqtt_port: int = 1883
     mqtt_use_tls: bool = False
     network_id: int = 1
     adapter: str = "serial"  # or "mqtt", "marilib-edge", "marilib-cloud"
-    devices: list[str] = dataclasses.field(default_factory=lambda: [])
+    devices: tuple[str, ...] = ()
     map_size: str = "2500x2500"
     ota_max_retries: int = OTA_MAX_RETRIES_DEFAULT
     ota_timeout: float = OTA_ACK_TIMEOUT_DEFAULT
+    ota_window: int = OTA_WINDOW_DEFAULT
     adapter_wait_timeout: float = 3
     verbose: bool = False
 
+    def __post_init__(self):
+        # Keep settings hashable whatever the type of devices sequence given
+        object.__setattr__(self, "devices", tuple(self.devices))
+
+
+def build_controller_settings(config: dict, **kwargs) -> ControllerSettings:
+    """Build controller settings from a merged CLI/config file configuration.
+
+    Extra keyword arguments are passed as is to ControllerSettings.
+    """
+    return ControllerSettings(
+        serial_port=config["serial_port"] or default_serial_port(),
+        serial_baudrate=config["baudrate"],
+        mqtt_host=config["mqtt_host"],
+        mqtt_port=config["mqtt_port"],
+        mqtt_use_tls=config["mqtt_use_tls"],
+        network_id=int(config["swarmit_network_id"], 16),
+        adapter=config["adapter"],
+        devices=tuple(d for d in config["devices"].split(",") if d),
+        verbose=config["verbose"],
+        **kwargs,
+    )
+
 
 class Controller:
     """Class used to control a swarm testbed."""
@@ -229,6 +261,15 @@ class Controller:
         self.settings = settings
         self._interface: GatewayAdapterBase = None
         self.status_data: dict[str, NodeStatus] = {}
+        # Incremented each time the status reported by a device changes
+        self.status_version: int = 0
+        # Index of the devices by status, kept in sync with status_data under
+        # _status_lock: the adapter and the cleanup threads both update them
+        self._status_lock = threading.Lock()
+        self._devices_by_status: dict[StatusType, set[str]] = {
+            status: set() for status in StatusType
+        }
+        self._selected_devices = frozenset(settings.devices)
         self.started_data: list[str] = []
         self.stopped_data: list[str] = []
         self.chunks: list[DataChunk] = []
@@ -236,28 +277,45 @@ class Controller:
         self.transfer_data: dict[str, TransferDataStatus] = {}
         self._known_devices: dict[str, StatusType] = {}
         self._stop_event = threading.Event()
+        self._chunk_acked = threading.Event()
         self._cleanup_thread = threading.Thread(
             target=self._cleanup_loop, daemon=True
         )
-        if self.settings.adapter == "cloud":
-            self._interface = MarilibCloudAdapter(
-                self.settings.mqtt_host,
-                self.settings.mqtt_port,
-                self.settings.mqtt_use_tls,
-                self.settings.network_id,
-                verbose=self.settings.verbose,
-                busy_wait_timeout=self.settings.adapter_wait_timeout,
-            )
-        else:
-            self._interface = MarilibEdgeAdapter(
-                self.settings.serial_port,
-                self.settings.serial_baudrate,
-                verbose=self.settings.verbose,
-                busy_wait_timeout=self.settings.adapter_wait_timeout,
-            )
+        self._interface = self._create_interface()
         self._interface.init(self.on_frame_received)
         self._cleanup_thread.start()
 
+    def _create_interface(self) -> GatewayAdapterBase:
+        """Create the gateway adapter, retrying with an exponential backoff."""
+        delay = ADAPTER_INIT_RETRY_DELAY
+        for attempt in range(1, ADAPTER_INIT_MAX_ATTEMPTS + 1):
+            try:
+                if self.settings.adapter == "cloud":
+                    return MarilibCloudAdapter(
+                        self.settings.mqtt_host,
+                        self.settings.mqtt_port,
+                        self.settings.mqtt_use_tls,
+                        self.settings.network_id,
+                        verbose=self.settings.verbose,
+                        busy_wait_timeout=self.settings.adapter_wait_timeout,
+                    )
+                return MarilibEdgeAdapter(
+                    self.settings.serial_port,
+                    self.settings.serial_baudrate,
+                    verbose=self.settings.verbose,
+                    busy_wait_timeout=self.settings.adapter_wait_timeout,
+                )
+            except AdapterInitError as exc:
+                if attempt == ADAPTER_INIT_MAX_ATTEMPTS:
+                    raise
+                self.logger.warning(
+                    "Adapter initialization failed, retrying",
+                    attempt=attempt,
+                    error=str(exc),
+                )
+                time.sleep(delay)
+                delay *= 2
+
     @property
     def known_devices(self) -> dict[str, StatusType]:
         """Return the known devices."""
@@ -266,52 +324,38 @@ class Controller:
             self._known_devices = self.status_data
         return self._known_devices
 
+    def devices_with_status(self, *statuses: StatusType) -> set[str]:
+        """Return a snapshot of the devices in one of the given statuses."""
+        devices = set()
+        with self._status_lock:
+            for status in statuses:
+                devices |= self._devices_by_status[status]
+        return devices
+
+    def _selected_devices_with_status(self, *statuses: StatusType):
+        known_devices = self.known_devices.copy()
+        devices = self.devices_with_status(*statuses)
+        if self._selected_devices:
+            devices &= self._selected_devices
+        # Keep the order of the known devices
+        return [addr for addr in known_devices if addr in devices]
+
     @property
     def running_devices(self) -> list[str]:
         """Return the running devices."""
-        return [
-            addr
-            for addr, node in self.known_devices.items()
-            if (
-                (
-                    node.status == StatusType.Running
-                    or node.status == StatusType.Programming
-                )
-                and (
-                    not self.settings.devices or addr in self.settings.devices
-                )
-            )
-        ]
+        return self._selected_devices_with_status(
+            StatusType.Running, StatusType.Programming
+        )
 
     @property
     def resetting_devices(self) -> list[str]:
         """Return the resetting devices."""
-        return [
-            device_addr
-            for device_addr, node in self.known_devices.items()
-            if (
-                node.status == StatusType.Resetting
-                and (
-                    not self.settings.devices
-                    or device_addr in self.settings.devices
-                )
-            )
-        ]
+        return self._selected_devices_with_status(StatusType.Resetting)
 
     @property
     def ready_devices(self) -> list[str]:
         """Return the ready devices."""
-        return [
-            device_addr
-            for device_addr, node in self.known_devices.items()
-            if (
-                node.status == StatusType.Bootloader
-                and (
-                    not self.settings.devices
-                    or device_addr in self.settings.devices
-                )
-            )
-        ]
+        return self._selected_devices_with_status(StatusType.Bootloader)
 
     @property
     def interface(self) -> GatewayAdapterBase:
@@ -325,13 +369,17 @@ class Controller:
 
     def cleanup_inactive(self, timeout):
         now = time.time()
-        inactive = [
-            addr
-            for addr, status in self.status_data.items()
-            if now - status.last_updated_at > timeout
-        ]
-        for addr in inactive:
-            del self.status_data[addr]
+        with self._status_lock:
+            inactive = [
+                addr
+                for addr, status in self.status_data.items()
+                if now - status.last_updated_at > timeout
+            ]
+            for addr in inactive:
+                status = self.status_data.pop(addr).status
+                self._devices_by_status[status].discard(addr)
+            if inactive:
+                self.status_version += 1
 
     def terminate(self):
         """Terminate the controller."""
@@ -359,7 +407,18 @@ class Controller:
                 pos_y=packet.payload.pos_y,
                 last_updated_at=now,
             )
-            self.status_data.update({device_addr: status})
+            with self._status_lock:
+                previous = self.status_data.get(device_addr)
+                if previous is not None and previous.status != status.status:
+                    self._devices_by_status[previous.status].discard(
+                        device_addr
+                    )
+                self._devices_by_status[status.status].add(device_addr)
+                self.status_data[device_addr] = status
+                # Nodes report their status periodically, most reports change
+                # nothing but the update time
+                if status != previous:
+                    self.status_version += 1
         elif (
             packet.payload_type == PayloadType.SWARMIT_OTA_START_ACK
             and device_addr not in self.start_ota_data.addrs
@@ -383,6 +442,7 @@ class Controller:
                 self.transfer_data[device_addr].chunks[
                     packet.payload.index
                 ].acked = 1
+                self._chunk_acked.set()
         elif packet.payload_type == PayloadType.SWARMIT_EVENT_LOG:
             if (
                 self.settings.devices
@@ -413,16 +473,20 @@ class Controller:
                 timeout -= 0.01
                 time.sleep(0.01)
 
-    def status(self, timeout=STATUS_TIMEOUT, watch=False):
+    def status(self, timeout=None, watch=False):
         """Request the status of the testbed."""
+        if timeout is None:
+            timeout = STATUS_TIMEOUT
         self._live_status(timeout, devices=self.settings.devices, watch=watch)
 
     def _send_start(self, device_addr: str):
         payload = PayloadStart()
         self.send_payload(int(device_addr, 16), payload)
 
-    def start(self, devices=None, timeout=COMMAND_TIMEOUT):
+    def start(self, devices=None, timeout=None):
         """Start the application."""
+        if timeout is None:
+            timeout = COMMAND_TIMEOUT
         if devices is None:
             devices = self.settings.devices or []
         ready_devices = self.ready_devices
@@ -442,8 +506,10 @@ class Controller:
             time.sleep(COMMAND_ATTEMPT_DELAY)
         self._live_status(timeout, devices=ready_devices, message="to start")
 
-    def stop(self, devices=None, timeout=COMMAND_TIMEOUT):
+    def stop(self, devices=None, timeout=None):
         """Stop the application."""
+        if timeout is None:
+            timeout = COMMAND_TIMEOUT
         if devices is None:
             devices = self.settings.devices or []
         stoppable_devices = self.running_devices + self.resetting_devices
@@ -521,9 +587,7 @@ class Controller:
     ):
         def is_start_ota_acknowledged():
             if int(device_addr, 16) == BROADCAST_ADDRESS:
-                return sorted(self.start_ota_data.addrs) == sorted(
-                    devices_to_flash
-                )
+                return set(self.start_ota_data.addrs) == set(devices_to_flash)
             else:
                 return device_addr in self.start_ota_data.addrs
 
@@ -544,13 +608,21 @@ class Controller:
             time.sleep(0.001)
             send = time.time() - send_time > self.settings.ota_timeout
 
-    def start_ota(self, firmware, devices=None) -> dict:
-        """Start the OTA process."""
+    def start_ota(self, firmware, devices=None, fw_hash=None) -> dict:
+        """Start the OTA process.
+
+        fw_hash is the SHA256 digest of the firmware, computed here if not
+        provided.
+        """
         if devices is None:
             devices = self.settings.devices or []
         self.start_ota_data = StartOtaData()
         self.chunks = []
-        digest = hashes.Hash(hashes.SHA256())
+        digest = None
+        if fw_hash is None:
+            digest = hashes.Hash(hashes.SHA256())
+        # slicing a memoryview doesn't copy the underlying firmware data
+        firmware_view = memoryview(firmware)
         chunks_count = int(len(firmware) / CHUNK_SIZE) + int(
             len(firmware) % CHUNK_SIZE != 0
         )
@@ -563,12 +635,13 @@ class Controller:
                 )
             else:
                 chunk_size = CHUNK_SIZE
-            data = firmware[
+            view = firmware_view[
                 chunk_idx * CHUNK_SIZE : chunk_idx * CHUNK_SIZE + chunk_size
             ]
-            digest.update(data)
+            if digest is not None:
+                digest.update(view)
             chunk_sha = hashes.Hash(hashes.SHA256())
-            chunk_sha.update(data)
+            chunk_sha.update(view)
             self.chunks.append(
                 DataChunk(
                     index=chunk_idx,
@@ -576,10 +649,12 @@ class Controller:
                     sha=chunk_sha.finalize()[
                         :8
                     ],  # the first 8 bytes should be enough
-                    data=data,
+                    data=bytes(view),
                 )
             )
-        self.start_ota_data.fw_hash = digest.finalize()
+        self.start_ota_data.fw_hash = (
+            digest.finalize() if digest is not None else bytes(fw_hash)
+        )
         self.start_ota_data.chunks = len(self.chunks)
         devices_to_flash = self.ready_devices
         if not devices:
@@ -600,74 +675,142 @@ class Controller:
             ),
         }
 
+    def _is_chunk_acknowledged(
+        self, chunk: DataChunk, device_addr: str, devices_to_flash: set[str]
+    ) -> bool:
+        if int(device_addr, 16) == BROADCAST_ADDRESS:
+            return self.transfer_data.keys() == set(devices_to_flash) and all(
+                status.chunks[chunk.index].acked
+                for status in self.transfer_data.values()
+            )
+        return (
+            device_addr in self.transfer_data.keys()
+            and self.transfer_data[device_addr].chunks[chunk.index].acked
+        )
+
+    def _send_chunk(
+        self,
+        packet: bytes,
+        chunk: DataChunk,
+        device_addr: str,
+        devices_to_flash: set[str],
+        retries_count: int,
+    ):
+        self.interface.send_bytes(int(device_addr, 16), packet)
+        if self.settings.verbose:
+            missing_acks = [
+                addr
+                for addr in devices_to_flash
+                if addr not in self.transfer_data
+                or not self.transfer_data[addr].chunks[chunk.index].acked
+            ]
+            print(
+                f"Transferring chunk {chunk.index + 1}/{self.start_ota_data.chunks} to {device_addr} "
+                f"- {retries_count} retries "
+                f"- {len(missing_acks)} missing acks: {', '.join(missing_acks) if missing_acks else 'none'}"
+            )
+        if int(device_addr, 16) == BROADCAST_ADDRESS:
+            for addr in devices_to_flash:
+                self.transfer_data[addr].chunks[
+                    chunk.index
+                ].retries = retries_count
+        else:
+            self.transfer_data[device_addr].chunks[
+                chunk.index
+            ].retries = retries_count
+
     def send_chunk(
         self,
         chunk: DataChunk,
         device_addr: str,
         devices_to_flash: set[str],
     ):
-        def is_chunk_acknowledged():
-            if int(device_addr, 16) == BROADCAST_ADDRESS:
-                return sorted(self.transfer_data.keys()) == sorted(
-                    devices_to_flash
-                ) and all(
-                    [
-                        status.chunks[chunk.index].acked
-                        for status in self.transfer_data.values()
-                    ]
-                )
-            else:
-                return (
-                    device_addr in self.transfer_data.keys()
-                    and self.transfer_data[device_addr]
-                    .chunks[chunk.index]
-                    .acked
-                )
+        """Send a single chunk, retrying until it is acknowledged."""
+        self.send_chunks(
+            [device_addr], devices_to_flash, chunks=[chunk], ota_window=1
+        )
 
-        payload = PayloadOTAChunk(
-            index=chunk.index,
-            count=chunk.size,
-            sha=chunk.sha,
-            chunk=chunk.data,
+    def send_chunks(
+        self,
+        destinations: list[str],
+        devices_to_flash: set[str],
+        on_chunk_sent: callable = None,
+        ota_window: int = None,
+        chunks: list[DataChunk] = None,
+    ):
+        """Send the chunks (default to all chunks) to the destinations.
+
+        Up to `ota_window` chunks (default to the one in settings) are kept in
+        flight: new chunks are sent without waiting for the acknowledgment of
+        the previous ones.
+        """
+        if chunks is None:
+            chunks = self.chunks
+        pending = deque(
+            (chunk, addr) for chunk in chunks for addr in destinations
         )
-        send_time = time.time()
-        send = True
-        retries_count = 0
-        while (
-            not is_chunk_acknowledged()
-            and retries_count <= self.settings.ota_max_retries
-        ):
-            if send is True:
-                self.send_payload(int(device_addr, 16), payload)
-                if self.settings.verbose:
-                    missing_acks = [
-                        addr
-                        for addr in devices_to_flash
-                        if addr not in self.transfer_data
-                        or not self.transfer_data[addr]
-                        .chunks[chunk.index]
-                        .acked
-                    ]
-                    print(
-                        f"Transferring chunk {chunk.index + 1}/{self.start_ota_data.chunks} to {device_addr} "
-                        f"- {retries_count} retries "
-                        f"- {len(missing_acks)} missing acks: {', '.join(missing_acks) if missing_acks else 'none'}"
+        remaining = {chunk.index: len(destinations) for chunk in chunks}
+        # (chunk index, destination) -> [chunk, send time, retries count]
+        in_flight = {}
+        # chunks are serialized once, whatever the number of destinations
+        # and retries
+        packets: dict[int, bytes] = {}
+        if ota_window is None:
+            ota_window = self.settings.ota_window
+        window = max(ota_window, 1)
+        while pending or in_flight:
+            # cleared before checking the acknowledgments, so that an ack
+            # received meanwhile wakes up the wait below
+            self._chunk_acked.clear()
+            while pending and len(in_flight) < window:
+                chunk, addr = pending.popleft()
+                in_flight[(chunk.index, addr)] = [chunk, 0, 0]
+            for (_, addr), state in list(in_flight.items()):
+                chunk, send_time, retries_count = state
+                if (
+                    self._is_chunk_acknowledged(chunk, addr, devices_to_flash)
+                    or retries_count > self.settings.ota_max_retries
+                ):
+                    del in_flight[(chunk.index, addr)]
+                    remaining[chunk.index] -= 1
+                    if remaining[chunk.index] == 0 and on_chunk_sent:
+                        on_chunk_sent(chunk)
+                    continue
+                if (
+                    retries_count == 0
+                    or time.time() - send_time > self.settings.ota_timeout
+                ):
+                    if chunk.index not in packets:
+                        packets[chunk.index] = Packet.from_payload(
+                            PayloadOTAChunk(
+                                index=chunk.index,
+                                count=chunk.size,
+                                sha=chunk.sha,
+                                chunk=chunk.data,
+                            )
+                        ).to_bytes()
+                    self._send_chunk(
+                        packets[chunk.index],
+                        chunk,
+                        addr,
+                        devices_to_flash,
+                        retries_count,
                     )
-                if int(device_addr, 16) == BROADCAST_ADDRESS:
-                    for addr in devices_to_flash:
-                        self.transfer_data[addr].chunks[
-                            chunk.index
-                        ].retries = retries_count
-                else:
-                    self.transfer_data[device_addr].chunks[
-                        chunk.index
-                    ].retries = retries_count
-                send_time = time.time()
-                retries_count += 1
-            time.sleep(0.001)
-            send = time.time() - send_time > self.settings.ota_timeout
+                    state[1] = time.time()
+                    state[2] = retries_count + 1
+            if pending and len(in_flight) < window:
+                continue
+            # Wait for an acknowledgment or for the next retry deadline
+            next_retry = min(
+                (state[1] for state in in_flight.values()), default=0
+            )
+            self._chunk_acked.wait(
+                max(next_retry + self.settings.ota_timeout - time.time(), 0)
+            )
 
-    def transfer(self, firmware, devices) -> dict[str, TransferDataStatus]:
+    def transfer(
+        self, firmware, devices, ota_window: int = None
+    ) -> dict[str, TransferDataStatus]:
         """Transfer the firmware to the devices."""
         data_size = len(firmware)
         use_progress_bar = not self.settings.verbose
@@ -689,18 +832,22 @@ class Controller:
                 Chunk(index=f"{i:03d}", size=f"{self.chunks[i].size:03d}B")
                 for i in range(len(self.chunks))
             ]
-        for chunk in self.chunks:
-            if not self.settings.devices:
-                self.send_chunk(
-                    chunk,
-                    addr_to_hex(BROADCAST_ADDRESS),
-                    devices,
-                )
-            else:
-                for _addr in devices:
-                    self.send_chunk(chunk, _addr, devices)
-            if use_progress_bar:
+        if not self.settings.devices:
+            destinations = [addr_to_hex(BROADCAST_ADDRESS)]
+        else:
+            destinations = devices
+        on_chunk_sent = None
+        if use_progress_bar:
+
+            def on_chunk_sent(chunk):
                 progress.update(chunk.size)
+
+        self.send_chunks(
+            destinations,
+            devices,
+            on_chunk_sent=on_chunk_sent,
+            ota_window=ota_window,
+        )
         if self.settings.verbose:
             retries_count = sum(
                 self.transfer_data[_addr].chunks[_chunk].retries
@@ -1,8 +1,45 @@
+import functools
+import os
+import pathlib
 import tomllib
 
+from dotbot_utils.serial_interface import get_default_port
+
+try:
+    import rtoml
+except ImportError:
+    rtoml = None
+
+
+@functools.cache
+def default_serial_port():
+    """Return the default serial port, only detected on first use."""
+    return get_default_port()
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_toml_config(path, mtime_ns, size):
+    # Use the faster rtoml parser when it's available
+    if rtoml is not None:
+        return rtoml.load(pathlib.Path(path))
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
 
 def load_toml_config(path):
     if not path:
         return {}
-    with open(path, "rb") as f:
-        return tomllib.load(f)
+    stat = os.stat(path)
+    # The cache is keyed on the file stat so that any change to the file is
+    # picked up, return a copy so callers can't alter the cached data.
+    return dict(_parse_toml_config(path, stat.st_mtime_ns, stat.st_size))
+
+
+def merge_config(defaults, config_data, cli_args):
+    """Merge in order of priority: CLI > config > defaults."""
+    config = defaults.copy()
+    config.update((k, v) for k, v in config_data.items() if v is not None)
+    config.update(
+        (k, v) for k, v in cli_args.items() if v not in (None, False)
+    )
+    return config
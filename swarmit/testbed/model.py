@@ -7,10 +7,12 @@ from sqlalchemy import (
     String,
     TypeDecorator,
     create_engine,
+    event,
     text,
 )
-from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.engine import Connection, Engine, make_url
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import StaticPool
 
 Base = declarative_base()
 
@@ -35,12 +37,30 @@ class JWTRecord(Base):
 
     id_ = Column(Integer, primary_key=True, index=True)
     jwt = Column(String, unique=True, nullable=False)
-    date_start = Column(AwareDateTime, nullable=False)
-    date_end = Column(AwareDateTime, nullable=False)
+    # Indexed so the overlap triggers don't scan the whole table
+    date_start = Column(AwareDateTime, nullable=False, index=True)
+    date_end = Column(AwareDateTime, nullable=False, index=True)
+
+
+def _set_sqlite_pragmas(dbapi_connection, _):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
 
 
 def create_db_engine(url: str) -> Engine:
-    return create_engine(url, connect_args={"check_same_thread": False})
+    kwargs = {}
+    if make_url(url).database in (None, "", ":memory:"):
+        # Each connection to an in-memory database gets a new empty one, so
+        # share a single connection between all threads
+        kwargs["poolclass"] = StaticPool
+    engine = create_engine(
+        url, connect_args={"check_same_thread": False}, **kwargs
+    )
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
 
 
 def create_session_factory(engine: Engine):
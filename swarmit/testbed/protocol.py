@@ -1,10 +1,14 @@
 """Swarmit protocol definition."""
 
 import dataclasses
+import struct
+import typing
 from dataclasses import dataclass
 from enum import Enum, IntEnum
+from typing import ClassVar, Optional
 
 from dotbot_utils.protocol import (
+    PAYLOAD_PARSERS,
     Payload,
     PayloadFieldMetadata,
     register_parser,
@@ -55,23 +59,147 @@ class PayloadType(IntEnum):
     METRICS_PROBE = MariDefaultPayloadType.METRICS_PROBE
 
 
+_INT_FORMATS = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+
+@dataclass(slots=True)
+class StructPayload(Payload):
+    """Base class for payloads (de)serialized with a precompiled struct.
+
+    The layout is compiled from the metadata by compile_struct() when a
+    subclass is created, a variable length bytes field is only supported as
+    last field.
+    """
+
+    _STRUCT: ClassVar[struct.Struct] = struct.Struct("<")
+    _FIELDS: ClassVar[tuple[str, ...]] = ()
+    _FORMATS: ClassVar[tuple[str, ...]] = ()
+    _INT_FIELDS: ClassVar[tuple[bool, ...]] = ()
+    _SIZED_FIELDS: ClassVar[tuple[tuple[str, int], ...]] = ()
+    _TRAILING: ClassVar[Optional[str]] = None
+
+    def __init_subclass__(cls, **kwargs):
+        # Zero argument super() is broken for classes with dataclass slots
+        super(StructPayload, cls).__init_subclass__(**kwargs)
+        # dataclass(slots=True) creates the class a second time, the layout
+        # compiled for the first one is copied with the class namespace.
+        # Subclasses that don't redefine the metadata inherit the layout.
+        if "_STRUCT" not in cls.__dict__ and "metadata" in cls.__dict__:
+            compile_struct(cls)
+
+    def from_bytes(self, bytes_):
+        cls = type(self)
+        try:
+            values = cls._STRUCT.unpack_from(bytes_)
+        except struct.error as exc:
+            raise ValueError("Not enough bytes to parse") from exc
+        for name, value in zip(cls._FIELDS, values):
+            setattr(self, name, value)
+        if cls._TRAILING is not None:
+            offset = cls._STRUCT.size
+            length = self.count if "count" in cls._FIELDS else len(bytes_)
+            setattr(
+                self, cls._TRAILING, bytes(bytes_[offset : offset + length])
+            )
+        return self
+
+    def to_bytes(self, byteorder="little") -> bytes:
+        if byteorder != "little":
+            return Payload.to_bytes(self, byteorder)
+        cls = type(self)
+        # The struct format would silently pad or truncate the value
+        for name, length in cls._SIZED_FIELDS:
+            if len(getattr(self, name)) != length:
+                raise ValueError(f"'{name}' must be {length} bytes long")
+        try:
+            bytes_ = cls._STRUCT.pack(
+                *[
+                    int(getattr(self, name)) if is_int else getattr(self, name)
+                    for name, is_int in zip(cls._FIELDS, cls._INT_FIELDS)
+                ]
+            )
+        except struct.error as exc:
+            # Out of range values raise OverflowError, like with int.to_bytes,
+            # other errors (e.g. a wrong value type) are raised unchanged
+            for name, fmt, is_int in zip(
+                cls._FIELDS, cls._FORMATS, cls._INT_FIELDS
+            ):
+                if not is_int:
+                    continue
+                try:
+                    struct.pack(f"<{fmt}", int(getattr(self, name)))
+                except struct.error:
+                    raise OverflowError(f"'{name}': {exc}") from exc
+            raise
+        if cls._TRAILING is not None:
+            bytes_ += getattr(self, cls._TRAILING)
+        return bytes_
+
+
+def compile_struct(cls: type[StructPayload]):
+    """Compile the struct layout of a payload class from its metadata."""
+    if "__dataclass_fields__" in cls.__dict__:
+        fields = dataclasses.fields(cls)
+        metadata = fields[0].default_factory()
+        field_names = [field.name for field in fields[1:]]
+    else:
+        # Called from __init_subclass__, before the dataclass decorator runs.
+        # The type hints are ordered like the dataclass fields.
+        metadata = cls.__dict__["metadata"].default_factory()
+        field_names = [
+            name
+            for name, hint in typing.get_type_hints(cls).items()
+            if name != "metadata" and typing.get_origin(hint) is not ClassVar
+        ]
+    formats = []
+    names = []
+    int_fields = []
+    sized_fields = []
+    trailing = None
+    for field_metadata, name in zip(metadata, field_names):
+        if trailing is not None:
+            raise ValueError(f"'{trailing}' must be the last field of {cls}")
+        if field_metadata.type_ in (bytes, bytearray):
+            if field_metadata.length == 0:
+                trailing = name
+                continue
+            formats.append(f"{field_metadata.length}s")
+            int_fields.append(False)
+            sized_fields.append((name, field_metadata.length))
+        elif field_metadata.type_ is int:
+            int_format = _INT_FORMATS[field_metadata.length]
+            if field_metadata.signed:
+                int_format = int_format.lower()
+            formats.append(int_format)
+            int_fields.append(True)
+        else:
+            raise ValueError(f"Unsupported field type in {cls}")
+        names.append(name)
+    cls._STRUCT = struct.Struct("<" + "".join(formats))
+    cls._FIELDS = tuple(names)
+    cls._FORMATS = tuple(formats)
+    cls._INT_FIELDS = tuple(int_fields)
+    cls._SIZED_FIELDS = tuple(sized_fields)
+    cls._TRAILING = trailing
+
+
 # Requests
-@dataclass
-class PayloadStatus(Payload):
+# Metadata is shared by all instances of a payload class, it's never modified
+_STATUS_METADATA = (
+    PayloadFieldMetadata(name="device", disp="dev."),
+    PayloadFieldMetadata(name="status", disp="st."),
+    PayloadFieldMetadata(name="battery", disp="bat.", length=2),
+    PayloadFieldMetadata(name="pos_x", disp="pos x", length=4, signed=True),
+    PayloadFieldMetadata(name="pos_y", disp="pos y", length=4, signed=True),
+)
+
+
+@dataclass(slots=True)
+class PayloadStatus(StructPayload):
     """Dataclass that holds an application status notification packet."""
 
-    metadata: list[PayloadFieldMetadata] = dataclasses.field(
-        default_factory=lambda: [
-            PayloadFieldMetadata(name="device", disp="dev."),
-            PayloadFieldMetadata(name="status", disp="st."),
-            PayloadFieldMetadata(name="battery", disp="bat.", length=2),
-            PayloadFieldMetadata(
-                name="pos_x", disp="pos x", length=4, signed=True
-            ),
-            PayloadFieldMetadata(
-                name="pos_y", disp="pos y", length=4, signed=True
-            ),
-        ]
+    metadata: tuple[PayloadFieldMetadata, ...] = dataclasses.field(
+        default_factory=lambda: _STATUS_METADATA
     )
 
     device: DeviceType = DeviceType.Unknown
@@ -81,68 +209,78 @@ class PayloadStatus(Payload):
     pos_y: int = 0
 
 
-@dataclass
-class PayloadEmpty(Payload):
+_EMPTY_METADATA = ()
+
+
+@dataclass(slots=True)
+class PayloadEmpty(StructPayload):
     """Dataclass that holds an application request packet (start/stop/status)."""
 
-    metadata: list[PayloadFieldMetadata] = dataclasses.field(
-        default_factory=lambda: []
+    metadata: tuple[PayloadFieldMetadata, ...] = dataclasses.field(
+        default_factory=lambda: _EMPTY_METADATA
     )
 
 
-@dataclass
+@dataclass(slots=True)
 class PayloadStart(PayloadEmpty):
     """Dataclass that holds an application start request packet."""
 
 
-@dataclass
+@dataclass(slots=True)
 class PayloadStop(PayloadEmpty):
     """Dataclass that holds an application stop request packet."""
 
 
-@dataclass
-class PayloadReset(Payload):
+_RESET_METADATA = (
+    PayloadFieldMetadata(name="pos_x", length=4),
+    PayloadFieldMetadata(name="pos_y", length=4),
+)
+
+
+@dataclass(slots=True)
+class PayloadReset(StructPayload):
     """Dataclass that holds an application reset request packet."""
 
-    metadata: list[PayloadFieldMetadata] = dataclasses.field(
-        default_factory=lambda: [
-            PayloadFieldMetadata(name="pos_x", length=4),
-            PayloadFieldMetadata(name="pos_y", length=4),
-        ]
+    metadata: tuple[PayloadFieldMetadata, ...] = dataclasses.field(
+        default_factory=lambda: _RESET_METADATA
     )
 
     pos_x: int = 0
     pos_y: int = 0
 
 
-@dataclass
-class PayloadOTAStart(Payload):
+_OTA_START_METADATA = (
+    PayloadFieldMetadata(name="fw_length", disp="len.", length=4),
+    PayloadFieldMetadata(name="fw_chunk_counts", disp="chunks", length=4),
+)
+
+
+@dataclass(slots=True)
+class PayloadOTAStart(StructPayload):
     """Dataclass that holds an OTA start packet."""
 
-    metadata: list[PayloadFieldMetadata] = dataclasses.field(
-        default_factory=lambda: [
-            PayloadFieldMetadata(name="fw_length", disp="len.", length=4),
-            PayloadFieldMetadata(
-                name="fw_chunk_counts", disp="chunks", length=4
-            ),
-        ]
+    metadata: tuple[PayloadFieldMetadata, ...] = dataclasses.field(
+        default_factory=lambda: _OTA_START_METADATA
     )
 
     fw_length: int = 0
     fw_chunk_count: int = 0
 
 
-@dataclass
-class PayloadOTAChunk(Payload):
+_OTA_CHUNK_METADATA = (
+    PayloadFieldMetadata(name="index", disp="idx", length=4),
+    PayloadFieldMetadata(name="count", disp="size"),
+    PayloadFieldMetadata(name="sha", type_=bytes, length=8),
+    PayloadFieldMetadata(name="chunk", type_=bytes, length=0),
+)
+
+
+@dataclass(slots=True)
+class PayloadOTAChunk(StructPayload):
     """Dataclass that holds an OTA chunk packet."""
 
-    metadata: list[PayloadFieldMetadata] = dataclasses.field(
-        default_factory=lambda: [
-            PayloadFieldMetadata(name="index", disp="idx", length=4),
-            PayloadFieldMetadata(name="count", disp="size"),
-            PayloadFieldMetadata(name="sha", type_=bytes, length=8),
-            PayloadFieldMetadata(name="chunk", type_=bytes, length=0),
-        ]
+    metadata: tuple[PayloadFieldMetadata, ...] = dataclasses.field(
+        default_factory=lambda: _OTA_CHUNK_METADATA
     )
 
     index: int = 0
@@ -151,40 +289,44 @@ class PayloadOTAChunk(Payload):
     chunk: bytes = dataclasses.field(default_factory=lambda: bytearray)
 
 
-@dataclass
-class PayloadOTAStartAck(Payload):
+@dataclass(slots=True)
+class PayloadOTAStartAck(StructPayload):
     """Dataclass that holds an application OTA start ACK notification packet."""
 
-    metadata: list[PayloadFieldMetadata] = dataclasses.field(
-        default_factory=lambda: []
+    metadata: tuple[PayloadFieldMetadata, ...] = dataclasses.field(
+        default_factory=lambda: _EMPTY_METADATA
     )
 
 
-@dataclass
-class PayloadOTAChunkAck(Payload):
+_OTA_CHUNK_ACK_METADATA = (
+    PayloadFieldMetadata(name="index", disp="idx", length=4),
+)
+
+
+@dataclass(slots=True)
+class PayloadOTAChunkAck(StructPayload):
     """Dataclass that holds an application OTA chunk ACK notification packet."""
 
-    metadata: list[PayloadFieldMetadata] = dataclasses.field(
-        default_factory=lambda: [
-            PayloadFieldMetadata(name="index", disp="idx", length=4),
-        ]
+    metadata: tuple[PayloadFieldMetadata, ...] = dataclasses.field(
+        default_factory=lambda: _OTA_CHUNK_ACK_METADATA
     )
 
     index: int = 0
 
 
-@dataclass
-class PayloadEvent(Payload):
+_EVENT_METADATA = (
+    PayloadFieldMetadata(name="timestamp", disp="ts", length=4),
+    PayloadFieldMetadata(name="count", disp="len."),
+    PayloadFieldMetadata(name="data", disp="data", type_=bytes, length=0),
+)
+
+
+@dataclass(slots=True)
+class PayloadEvent(StructPayload):
     """Dataclass that holds an event notification packet."""
 
-    metadata: list[PayloadFieldMetadata] = dataclasses.field(
-        default_factory=lambda: [
-            PayloadFieldMetadata(name="timestamp", disp="ts", length=4),
-            PayloadFieldMetadata(name="count", disp="len."),
-            PayloadFieldMetadata(
-                name="data", disp="data", type_=bytes, length=0
-            ),
-        ]
+    metadata: tuple[PayloadFieldMetadata, ...] = dataclasses.field(
+        default_factory=lambda: _EVENT_METADATA
     )
 
     timestamp: int = 0
@@ -192,17 +334,18 @@ class PayloadEvent(Payload):
     data: bytes = dataclasses.field(default_factory=lambda: bytearray)
 
 
-@dataclass
-class PayloadMessage(Payload):
+_MESSAGE_METADATA = (
+    PayloadFieldMetadata(name="count", disp="len."),
+    PayloadFieldMetadata(name="message", disp="msg", type_=bytes, length=0),
+)
+
+
+@dataclass(slots=True)
+class PayloadMessage(StructPayload):
     """Dataclass that holds a message packet."""
 
-    metadata: list[PayloadFieldMetadata] = dataclasses.field(
-        default_factory=lambda: [
-            PayloadFieldMetadata(name="count", disp="len."),
-            PayloadFieldMetadata(
-                name="message", disp="msg", type_=bytes, length=0
-            ),
-        ]
+    metadata: tuple[PayloadFieldMetadata, ...] = dataclasses.field(
+        default_factory=lambda: _MESSAGE_METADATA
     )
 
     count: int = 0
@@ -221,3 +364,9 @@ register_parser(PayloadType.SWARMIT_OTA_CHUNK_ACK, PayloadOTAChunkAck)
 register_parser(PayloadType.SWARMIT_EVENT_LOG, PayloadEvent)
 register_parser(PayloadType.SWARMIT_MESSAGE, PayloadMessage)
 register_parser(PayloadType.METRICS_PROBE, MetricsProbePayload)
+
+# Parsers indexed by payload type, a list index is cheaper than a dict lookup
+# when dispatching received packets
+PARSER_TABLE: list[Optional[type[Payload]]] = [None] * 256
+for payload_type, parser in PAYLOAD_PARSERS.items():
+    PARSER_TABLE[payload_type] = parser
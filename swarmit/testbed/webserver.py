@@ -3,9 +3,12 @@
 import asyncio
 import base64
 import datetime
+import functools
+import itertools
+import json
 import os
+import time
 from contextlib import asynccontextmanager
-from dataclasses import asdict
 from typing import List, Optional, Union
 
 import jwt
@@ -18,16 +21,27 @@ from fastapi import (
 from fastapi import status as fastapi_status
 from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, field_validator
+from pydantic import (
+    BaseModel,
+    Field,
+    StrictStr,
+    ValidationError,
+    field_validator,
+)
 from sqlalchemy import asc
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from swarmit import __version__
-from swarmit.testbed.controller import Controller, ControllerSettings
+from swarmit.testbed.controller import (
+    Controller,
+    ControllerSettings,
+    NodeStatus,
+)
+from swarmit.testbed.logger import LOGGER
 from swarmit.testbed.model import (
     Base,
     JWTRecord,
@@ -37,8 +51,34 @@ from swarmit.testbed.model import (
 )
 from swarmit.testbed.protocol import StatusType
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 DATA_DIR = "./.data"
 API_DB_URL = f"sqlite:///{DATA_DIR}/database.db"
+ACCESS_LOG_SAMPLE_RATE = 100  # log one request out of ACCESS_LOG_SAMPLE_RATE
+
+
+def _dumps_json(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    # Same options as starlette JSONResponse.render()
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response serialized with orjson when it's installed."""
+
+    def render(self, content) -> bytes:
+        return _dumps_json(content)
 
 
 def get_db():
@@ -57,6 +97,7 @@ api = FastAPI(
     version=__version__,
     docs_url="/api",
     redoc_url=None,
+    default_response_class=FastJSONResponse,
 )
 api.add_middleware(
     CORSMiddleware,
@@ -66,38 +107,119 @@ api.add_middleware(
     allow_headers=["*"],
 )
 
+access_logger = LOGGER.bind(__context=__name__)
+_request_counter = itertools.count()
+
+
+class SampledAccessLogMiddleware:
+    """Log a sample of the requests instead of each one of them.
+
+    Plain ASGI middleware, the requests that are not sampled are handed over
+    to the application untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or next(_request_counter) % ACCESS_LOG_SAMPLE_RATE
+        ):
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status_code = None
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+        access_logger.info(
+            "HTTP request",
+            method=scope["method"],
+            path=scope["path"],
+            status=status_code,
+            duration_ms=round((time.perf_counter() - start) * 1000, 3),
+            sample_rate=ACCESS_LOG_SAMPLE_RATE,
+        )
+
+
+api.add_middleware(SampledAccessLogMiddleware)
+
+
 # Global lock to prevent concurrent controller access
 controller_lock = asyncio.Lock()
 
 
+@functools.lru_cache(maxsize=8)
+def _read_key(path: str, mtime_ns: int) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def _load_key(path: str) -> str:
+    # The cache is keyed on the file modification time so that a new key is
+    # picked up without restarting the server
+    return _read_key(path, os.stat(path).st_mtime_ns)
+
+
 # Load Ed25519 keys
 def get_private_key() -> str:
-    with open(f"{DATA_DIR}/private.pem") as f:
-        return f.read()
+    return _load_key(f"{DATA_DIR}/private.pem")
 
 
 def get_public_key() -> str:
-    with open(f"{DATA_DIR}/public.pem") as f:
-        return f.read()
+    return _load_key(f"{DATA_DIR}/public.pem")
 
 
 ALGORITHM = "EdDSA"
+JWT_CACHE_SIZE = 1024  # maximum number of verified tokens kept in memory
+JWT_CACHE_TTL = 60  # s
+JWT_VALIDITY = datetime.timedelta(minutes=30)
+# Range of the reservations listed by /records, relative to now
+RECORDS_PAST = datetime.timedelta(days=1)
+RECORDS_FUTURE = datetime.timedelta(days=30)
 security = HTTPBearer()
 
 
-def verify_jwt(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def _current_public_key(state) -> Optional[str]:
+    """Return the public key, forget the verified tokens when it changed."""
+    # Only a stat of public.pem as long as the key doesn't change, it's served
+    # by /public_key from the same cache
     try:
         public_key = get_public_key()
     except FileNotFoundError:
+        public_key = None
+    if public_key != state.public_key:
+        state.public_key = public_key
+        state.verified_tokens.clear()
+    return public_key
+
+
+async def verify_jwt(
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+):
+    public_key = _current_public_key(request.app.state)
+    if public_key is None:
         raise HTTPException(
             status_code=fastapi_status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="public.pem not found; public key unavailable",
         )
+    token = credentials.credentials
+    verified_tokens = request.app.state.verified_tokens
+    now = time.time()
+    if token in verified_tokens:
+        payload, expires_at = verified_tokens[token]
+        if now < expires_at:
+            return payload
+        del verified_tokens[token]
     try:
-        payload = jwt.decode(
-            credentials.credentials, public_key, algorithms=[ALGORITHM]
-        )
-        return payload
+        payload = jwt.decode(token, public_key, algorithms=[ALGORITHM])
     except jwt.ExpiredSignatureError:
         raise HTTPException(
             status_code=fastapi_status.HTTP_401_UNAUTHORIZED,
@@ -108,6 +230,23 @@ def verify_jwt(credentials: HTTPAuthorizationCredentials = Depends(security)):
             status_code=fastapi_status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token",
         )
+    _cache_verified_token(verified_tokens, token, payload, now)
+    return payload
+
+
+def _cache_verified_token(verified_tokens, token, payload, now):
+    """Keep a verified token until it expires, at most JWT_CACHE_TTL."""
+    if len(verified_tokens) >= JWT_CACHE_SIZE:
+        for cached_token, (_, expires_at) in list(verified_tokens.items()):
+            if expires_at <= now:
+                del verified_tokens[cached_token]
+    if len(verified_tokens) >= JWT_CACHE_SIZE:
+        # Drop the oldest entry
+        del verified_tokens[next(iter(verified_tokens))]
+    expires_at = now + JWT_CACHE_TTL
+    if "exp" in payload:
+        expires_at = min(expires_at, payload["exp"])
+    verified_tokens[token] = (payload, expires_at)
 
 
 def init_api(api: FastAPI, settings: ControllerSettings):
@@ -122,6 +261,9 @@ def init_api(api: FastAPI, settings: ControllerSettings):
 
         # Initialize DB schema
         Base.metadata.create_all(bind=engine)
+        # Indexes added to an already existing table are not created above
+        for index in JWTRecord.__table__.indexes:
+            index.create(bind=engine, checkfirst=True)
 
         # Create triggers
         with engine.connect() as conn:
@@ -129,6 +271,15 @@ def init_api(api: FastAPI, settings: ControllerSettings):
 
         # Run on startup
         app.state.controller = controller
+        try:
+            app.state.public_key = get_public_key()
+        except FileNotFoundError:
+            app.state.public_key = None
+        app.state.verified_tokens = {}
+        app.state.status_cache = (None, b"")
+        app.state.settings_response = build_settings_response(
+            controller.settings
+        )
 
         yield
 
@@ -142,25 +293,27 @@ def init_api(api: FastAPI, settings: ControllerSettings):
 
 
 class DeviceList(BaseModel):
-    devices: Optional[Union[str, List[str]]] = None
-
-    @field_validator("devices", mode="before")
-    def validate_devices(cls, v):
-        if v is None:
-            return None
-        if isinstance(v, str):
-            return [v]
-        if isinstance(v, list):
-            # ensure list of strings
-            if not all(isinstance(item, str) for item in v):
+    devices: Optional[Union[StrictStr, List[StrictStr]]] = None
+
+    @field_validator("devices", mode="wrap")
+    @classmethod
+    def validate_devices(cls, v, handler):
+        # Types are checked by pydantic, only the error messages are custom
+        try:
+            devices = handler(v)
+        except ValidationError:
+            if isinstance(v, list):
                 raise ValueError("devices must be a list of strings")
-            return v
-        raise ValueError("devices must be a string or list of strings")
+            raise ValueError("devices must be a string or list of strings")
+        if isinstance(devices, str):
+            return [devices]
+        return devices
 
 
-class FlashRequest(BaseModel):
+class FlashRequest(DeviceList):
     firmware_b64: str
-    devices: Optional[Union[str, List[str]]] = None
+    # Number of chunks sent without waiting for acks, use settings if None
+    ota_window: Optional[int] = Field(default=None, ge=1)
 
 
 @api.post("/flash", dependencies=[Depends(verify_jwt)])
@@ -168,8 +321,8 @@ async def flash_firmware(payload: FlashRequest, request: Request):
     controller: Controller = request.app.state.controller
 
     try:
-        fw_bytes = base64.b64decode(payload.firmware_b64)
-        fw = bytearray(fw_bytes)
+        # The firmware is only read, no need to copy it into a bytearray
+        fw = base64.b64decode(payload.firmware_b64)
     except Exception as e:
         raise HTTPException(
             status_code=400, detail=f"invalid firmware encoding: {e}"
@@ -177,10 +330,13 @@ async def flash_firmware(payload: FlashRequest, request: Request):
 
     # Normalize devices
     devices = payload.devices
-    if all(
-        controller.status_data[device].status != StatusType.Bootloader
-        for device in devices
-    ):
+    bootloader_devices = controller.devices_with_status(StatusType.Bootloader)
+    ready_devices = (
+        [device for device in devices if device in bootloader_devices]
+        if devices
+        else list(bootloader_devices)
+    )
+    if not ready_devices:
         raise HTTPException(
             status_code=400, detail="no ready devices to flash"
         )
@@ -188,7 +344,7 @@ async def flash_firmware(payload: FlashRequest, request: Request):
     async with controller_lock:
 
         start_data = (
-            await run_in_threadpool(controller.start_ota, fw, devices)
+            await run_in_threadpool(controller.start_ota, fw, ready_devices)
             if devices
             else await run_in_threadpool(controller.start_ota, fw)
         )
@@ -201,27 +357,43 @@ async def flash_firmware(payload: FlashRequest, request: Request):
             )
 
         data = await run_in_threadpool(
-            controller.transfer, fw, start_data["acked"]
+            controller.transfer,
+            fw,
+            start_data["acked"],
+            ota_window=payload.ota_window,
         )
 
     if all(device.success for device in data.values()) is False:
         raise HTTPException(status_code=400, detail="transfer failed")
 
-    return JSONResponse(content={"response": "success"})
+    return {"response": "success"}
+
+
+def _status_row(status: NodeStatus) -> dict:
+    # Explicit field reads are cheaper than dataclasses.asdict(). The update
+    # time is left out, it changes with each status report of the nodes.
+    return {
+        "device": status.device.name,
+        "status": status.status.name,
+        "battery": status.battery,
+        "pos_x": status.pos_x,
+        "pos_y": status.pos_y,
+    }
 
 
 @api.get("/status")
 async def status(request: Request):
     controller: Controller = request.app.state.controller
-    response = {
-        k: {
-            **asdict(v),
-            "device": v.device.name,
-            "status": v.status.name,
+    # The response is only serialized again when the status data has changed
+    version = controller.status_version
+    cached_version, content = request.app.state.status_cache
+    if cached_version != version:
+        response = {
+            k: _status_row(v) for k, v in controller.status_data.copy().items()
         }
-        for k, v in controller.status_data.items()
-    }
-    return JSONResponse(content={"response": response})
+        content = _dumps_json({"response": response})
+        request.app.state.status_cache = (version, content)
+    return Response(content=content, media_type="application/json")
 
 
 class SettingsResponse(BaseModel):
@@ -230,27 +402,28 @@ class SettingsResponse(BaseModel):
     area_height: int
 
 
-@api.get("/settings", response_model=SettingsResponse)
-async def settings(request: Request):
-    controller: Controller = request.app.state.controller
-    map_size = controller.settings.map_size
-    width_str, height_str = map_size.lower().split('x')
+def build_settings_response(settings: ControllerSettings) -> SettingsResponse:
+    width_str, height_str = settings.map_size.lower().split('x')
     return SettingsResponse(
-        network_id=controller.settings.network_id,
+        network_id=settings.network_id,
         area_width=int(width_str),
         area_height=int(height_str),
     )
 
 
-@api.post("/start")
-async def start(
-    request: Request, payload: DeviceList, _token_payload=Depends(verify_jwt)
-):
+@api.get("/settings", response_model=SettingsResponse)
+async def settings(request: Request):
+    # Settings never change once the API is started, see init_api
+    return request.app.state.settings_response
+
+
+@api.post("/start", dependencies=[Depends(verify_jwt)])
+async def start(request: Request, payload: DeviceList):
     controller: Controller = request.app.state.controller
     async with controller_lock:
         await run_in_threadpool(controller.start, devices=payload.devices)
 
-    return JSONResponse(content={"response": "done"})
+    return {"response": "done"}
 
 
 @api.post("/stop", dependencies=[Depends(verify_jwt)])
@@ -259,7 +432,7 @@ async def stop(request: Request, payload: DeviceList):
     async with controller_lock:
         await run_in_threadpool(controller.stop, devices=payload.devices)
 
-    return JSONResponse(content={"response": "done"})
+    return {"response": "done"}
 
 
 class IssueRequest(BaseModel):
@@ -277,7 +450,7 @@ def issue_token(req: IssueRequest, db: Session = Depends(get_db)):
             status_code=400, detail="Invalid 'start' time format (use ISO8601)"
         )
 
-    end = start + datetime.timedelta(minutes=30)
+    end = start + JWT_VALIDITY
     payload = {
         "iat": datetime.datetime.now(datetime.timezone.utc),
         "nbf": start,
@@ -297,7 +470,6 @@ def issue_token(req: IssueRequest, db: Session = Depends(get_db)):
     db.add(db_record)
     try:
         db.commit()
-        db.refresh(db_record)
     except IntegrityError:
         db.rollback()
         raise HTTPException(status_code=400, detail="Timeslot already full")
@@ -316,7 +488,7 @@ def public_key():
             detail="public.pem not found; public key unavailable",
         )
 
-    return JSONResponse(content={"data": public_key})
+    return {"data": public_key}
 
 
 class JWTRecordOut(BaseModel):
@@ -331,8 +503,8 @@ class JWTRecordOut(BaseModel):
 @api.get("/records", response_model=list[JWTRecordOut])
 def list_records(db: Session = Depends(get_db)):
     now = datetime.datetime.now(datetime.timezone.utc)
-    yesterday = now - datetime.timedelta(days=1)
-    one_month_later = now + datetime.timedelta(days=30)
+    yesterday = now - RECORDS_PAST
+    one_month_later = now + RECORDS_FUTURE
     records = (
         db.query(JWTRecord)
         .filter(
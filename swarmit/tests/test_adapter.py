@@ -1,17 +1,29 @@
-from unittest.mock import patch
+import time
+from unittest.mock import MagicMock
 
+import pytest
 from dotbot_utils.protocol import Packet
 from marilib.mari_protocol import Frame as MariFrame
 from marilib.mari_protocol import Header as MariHeader
 from marilib.model import EdgeEvent
 
-from swarmit.testbed.adapter import MarilibCloudAdapter, MarilibEdgeAdapter
+from swarmit.testbed.adapter import (
+    AdapterInitError,
+    MarilibCloudAdapter,
+    MarilibEdgeAdapter,
+    parse_packet,
+)
 from swarmit.testbed.protocol import PayloadStatus
 
 
-@patch("swarmit.testbed.adapter.MarilibSerialAdapter")
-@patch("swarmit.testbed.adapter.MarilibEdge.send_frame")
-def test_marilib_edge_adapter(send_frame_mock, _, capsys):
+def test_marilib_edge_adapter(monkeypatch, capsys):
+    send_frame_mock = MagicMock()
+    monkeypatch.setattr(
+        "swarmit.testbed.adapter.MarilibSerialAdapter", MagicMock()
+    )
+    monkeypatch.setattr(
+        "swarmit.testbed.adapter.MarilibEdge.send_frame", send_frame_mock
+    )
     adapter = MarilibEdgeAdapter(
         port="p", baudrate=1, verbose=True, busy_wait_timeout=0.1
     )
@@ -57,22 +69,58 @@ def test_marilib_edge_adapter(send_frame_mock, _, capsys):
     adapter.close()
 
 
-@patch("swarmit.testbed.adapter.MarilibSerialAdapter")
-def test_marilib_edge_adapter_init_failed(serial_adapter_mock, capsys):
-    serial_adapter_mock.side_effect = Exception("init failed")
-    with patch("sys.exit") as exit_mock:
+def test_marilib_edge_adapter_init_failed(monkeypatch):
+    monkeypatch.setattr(
+        "swarmit.testbed.adapter.MarilibSerialAdapter",
+        MagicMock(side_effect=Exception("init failed")),
+    )
+    with pytest.raises(
+        AdapterInitError, match="Error initializing MarilibEdge: init failed"
+    ):
         MarilibEdgeAdapter(
             port="p", baudrate=1, verbose=True, busy_wait_timeout=0.1
         )
 
-    exit_mock.assert_called_with(1)
-    out, _ = capsys.readouterr()
-    assert "Error initializing MarilibEdge" in out
 
+def test_marilib_edge_adapter_wait_node_joined(monkeypatch):
+    monkeypatch.setattr(
+        "swarmit.testbed.adapter.MarilibSerialAdapter", MagicMock()
+    )
+    adapter = MarilibEdgeAdapter(
+        port="p", baudrate=1, verbose=True, busy_wait_timeout=5
+    )
+    adapter.on_event(EdgeEvent.NODE_JOINED, None)
+    start = time.monotonic()
+    adapter.init(lambda *_: None)
+    # waiting stops as soon as a node has joined
+    assert time.monotonic() - start < 1
+    adapter.close()
 
-@patch("swarmit.testbed.adapter.MarilibMQTTAdapter")
-@patch("swarmit.testbed.adapter.MarilibCloud.send_frame")
-def test_marilib_cloud_adapter(send_frame_mock, _, capsys):
+
+def test_marilib_edge_adapter_update_thread(monkeypatch):
+    update_mock = MagicMock()
+    monkeypatch.setattr("swarmit.testbed.adapter.MARI_UPDATE_PERIOD", 0.01)
+    monkeypatch.setattr(
+        "swarmit.testbed.adapter.MarilibSerialAdapter", MagicMock()
+    )
+    monkeypatch.setattr(
+        "swarmit.testbed.adapter.MarilibEdge.update", update_mock
+    )
+    adapter = MarilibEdgeAdapter(port="p", baudrate=1)
+    time.sleep(0.1)
+    adapter.close()
+    assert update_mock.called
+    assert not adapter._update_thread.is_alive()
+
+
+def test_marilib_cloud_adapter(monkeypatch, capsys):
+    send_frame_mock = MagicMock()
+    monkeypatch.setattr(
+        "swarmit.testbed.adapter.MarilibMQTTAdapter", MagicMock()
+    )
+    monkeypatch.setattr(
+        "swarmit.testbed.adapter.MarilibCloud.send_frame", send_frame_mock
+    )
     adapter = MarilibCloudAdapter(
         host="h",
         port=1,
@@ -124,10 +172,14 @@ def test_marilib_cloud_adapter(send_frame_mock, _, capsys):
     adapter.close()
 
 
-@patch("swarmit.testbed.adapter.MarilibMQTTAdapter")
-def test_marilib_cloud_adapter_init_failed(mqtt_adapter_mock, capsys):
-    mqtt_adapter_mock.side_effect = Exception("init failed")
-    with patch("sys.exit") as exit_mock:
+def test_marilib_cloud_adapter_init_failed(monkeypatch):
+    monkeypatch.setattr(
+        "swarmit.testbed.adapter.MarilibMQTTAdapter",
+        MagicMock(side_effect=Exception("init failed")),
+    )
+    with pytest.raises(
+        AdapterInitError, match="Error initializing MarilibCloud: init failed"
+    ):
         MarilibCloudAdapter(
             host="h",
             port=1,
@@ -137,6 +189,14 @@ def test_marilib_cloud_adapter_init_failed(mqtt_adapter_mock, capsys):
             busy_wait_timeout=0.1,
         )
 
-    exit_mock.assert_called_with(1)
+
+def test_parse_packet(capsys):
+    packet = Packet().from_payload(PayloadStatus(device=1, status=2))
+    assert parse_packet(packet.to_bytes()) == packet
+    assert parse_packet(b"") is None
+    assert parse_packet(b"`\x01invalid", verbose=True) is None
     out, _ = capsys.readouterr()
-    assert "Error initializing MarilibCloud" in out
+    assert "Unsupported payload type '0x60'" in out
+    assert parse_packet(packet.to_bytes()[:2], verbose=True) is None
+    out, _ = capsys.readouterr()
+    assert "Error parsing packet" in out
@@ -1,22 +1,112 @@
-import sys
-from unittest.mock import PropertyMock, patch
-
+import collections
+import contextlib
+import functools
+import hashlib
+import io
+from types import SimpleNamespace
+
+import click
 import pytest
 from click.testing import CliRunner
 
-from swarmit.cli.main import main
+from swarmit.testbed.adapter import AdapterInitError
 from swarmit.testbed.controller import (
     ControllerSettings,
+    ResetLocation,
     StartOtaData,
     TransferDataStatus,
 )
 
-CLI_HELP_EXPECTED = """Usage: main [OPTIONS] COMMAND [ARGS]...
+
+@pytest.fixture(scope="module")
+def runner():
+    return CliRunner()
+
+
+@pytest.fixture(scope="module")
+def main_cmd():
+    # Imported on use so that collecting this module stays cheap
+    from swarmit.cli.main import main
+
+    return main
+
+
+class ControllerStub:
+    """Lightweight stand-in for the testbed controller used by the CLI.
+
+    Calls to any method are recorded in `calls`, their result is read from
+    `return_values` and an exception set in `side_effects` is raised instead.
+    """
+
+    def __init__(self):
+        self.settings = None
+        self.ready_devices = ["1"]
+        self.running_devices = []
+        self.resetting_devices = []
+        self.init_error = None
+        self.calls = collections.defaultdict(list)
+        self.return_values = {}
+        self.side_effects = {}
+
+    def __call__(self, settings):
+        # Replaces the Controller class, settings set by the test are kept
+        if self.init_error is not None:
+            raise self.init_error
+        if self.settings is None:
+            self.settings = settings
+        return self
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            self.calls[name].append((args, kwargs))
+            if name in self.side_effects:
+                raise self.side_effects[name]
+            return self.return_values.get(name)
+
+        return method
+
+
+@pytest.fixture
+def controller(request, monkeypatch):
+    # Direct attribute replacement is much cheaper than a mock.patch context
+    controller = ControllerStub()
+    monkeypatch.setattr("swarmit.cli.main.Controller", controller)
+    yield controller
+    # Commands must always terminate the controller, unless marked otherwise
+    if request.node.get_closest_marker("no_terminate") is None:
+        assert controller.calls["terminate"] == [((), {})]
+    else:
+        assert not controller.calls["terminate"]
+
+
+@functools.cache
+def cli_command(name):
+    """Return a CLI subcommand, looked up once per test session."""
+    from swarmit.cli.main import main
+
+    return main.commands[name]
+
+
+def invoke_direct(command_name, **params):
+    """Run a command callback in-process, bypassing the click parser."""
+    command = cli_command(command_name)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        with click.Context(
+            command, obj={"settings": ControllerSettings()}
+        ) as ctx:
+            ctx.invoke(command, **params)
+    return output.getvalue()
+
+
+def test_main_help(runner, main_cmd):
+    expected = """Usage: main [OPTIONS] COMMAND [ARGS]...
 
 Options:
   -c, --config-path FILE      Path to a .toml configuration file.
   -p, --port TEXT             Serial port to use to send the bitstream to the
-                              gateway. Default: /dev/ttyACM0.
+                              gateway. Default: first J-Link port found or
+                              /dev/ttyACM0.
   -b, --baudrate INTEGER      Serial port baudrate. Default: 1000000.
   -H, --mqtt-host TEXT        MQTT host. Default: localhost.
   -P, --mqtt-port INTEGER     MQTT port. Default: 1883.
@@ -39,295 +129,236 @@ Commands:
   status   Print current status of the robots.
   stop     Stop the user application.
 """
-
-
-@pytest.mark.skipif(sys.platform != "linux", reason="Serial port is different")
-def test_main_help():
-    runner = CliRunner()
-    result = runner.invoke(main, ["--help"])
-    assert result.exit_code == 0
-    assert result.output == CLI_HELP_EXPECTED
-
-
-@patch("swarmit.cli.main.Controller")
-def test_start(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
-    type(controller_mock().return_value).ready_devices = PropertyMock(
-        return_value=["1", "2"]
-    )
-    result = runner.invoke(main, ["start"])
-    assert result.exit_code == 0
-    assert not result.output.strip()
-    controller.start.assert_called_once()
-    controller.terminate.assert_called_once()
-
-
-@patch("swarmit.cli.main.Controller")
-def test_start_no_device(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
-    type(controller_mock.return_value).ready_devices = PropertyMock(
-        return_value=[]
-    )
-    result = runner.invoke(main, ["start"])
-    assert result.exit_code == 0
-    assert "No device to start" in result.output
-    controller.start.assert_not_called()
-    controller.terminate.assert_called_once()
-
-
-@patch("swarmit.cli.main.Controller")
-def test_stop(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
-    type(controller_mock.return_value).running_devices = PropertyMock(
-        return_value=["1", "2"]
-    )
-    result = runner.invoke(main, ["stop"])
-    assert result.exit_code == 0
-    assert not result.output.strip()
-    controller.stop.assert_called_once()
-    controller.terminate.assert_called_once()
-
-
-@patch("swarmit.cli.main.Controller")
-def test_stop_no_device(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
-    type(controller_mock.return_value).running_devices = PropertyMock(
-        return_value=[]
-    )
-    type(controller_mock.return_value).resetting_devices = PropertyMock(
-        return_value=[]
-    )
-    result = runner.invoke(main, ["stop"])
+    result = runner.invoke(main_cmd, ["--help"])
     assert result.exit_code == 0
-    assert "No device to stop" in result.output
-    controller.stop.assert_not_called()
-    controller.terminate.assert_called_once()
+    assert result.output == expected
 
 
-@patch("swarmit.cli.main.Controller")
-def test_reset(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
-    type(controller_mock.return_value).settings = PropertyMock(
-        return_value=ControllerSettings(devices=[1])
-    )
-    result = runner.invoke(main, ["reset", "1:0.5,0.5"])
-    assert result.exit_code == 0
-    controller.reset.assert_called_once()
-    controller.terminate.assert_called_once()
-
-
-@patch("swarmit.cli.main.Controller")
-def test_reset_no_match(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
-    type(controller_mock.return_value).settings = PropertyMock(
-        return_value=ControllerSettings(devices=[1])
-    )
-    result = runner.invoke(main, ["reset", "2:0.5,0.5"])
-    assert result.exit_code == 0
-    assert "Selected devices and reset locations do not match" in result.output
-    controller.reset.assert_not_called()
-    controller.terminate.assert_called_once()
+@pytest.mark.no_terminate
+def test_adapter_init_failed(runner, main_cmd, controller):
+    controller.init_error = AdapterInitError("init failed")
+    result = runner.invoke(main_cmd, ["status"])
+    assert result.exit_code == 1
+    assert "Error: init failed" in result.output
 
 
-@patch("swarmit.cli.main.Controller")
-def test_reset_no_device_selected(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
-    type(controller_mock.return_value).settings = PropertyMock(
-        return_value=ControllerSettings(devices=[])
-    )
-    result = runner.invoke(main, ["reset", "1:0.5,0.5"])
+@pytest.mark.parametrize(
+    "ready_devices,started,output",
+    [
+        (["1", "2"], True, ""),
+        ([], False, "No device to start"),
+    ],
+)
+def test_start(controller, ready_devices, started, output):
+    controller.ready_devices = ready_devices
+    assert invoke_direct("start").strip() == output
+    assert bool(controller.calls["start"]) is started
+
+
+@pytest.mark.parametrize(
+    "running_devices,resetting_devices,stopped,output",
+    [
+        (["1", "2"], [], True, ""),
+        ([], ["1"], True, ""),
+        ([], [], False, "No device to stop"),
+    ],
+)
+def test_stop(controller, running_devices, resetting_devices, stopped, output):
+    controller.running_devices = running_devices
+    controller.resetting_devices = resetting_devices
+    assert invoke_direct("stop").strip() == output
+    assert bool(controller.calls["stop"]) is stopped
+
+
+# ControllerSettings is frozen so instances can be shared between tests
+SETTINGS_NO_DEVICE = ControllerSettings(devices=())
+SETTINGS_ONE_DEVICE = ControllerSettings(devices=("00000001",))
+SETTINGS_TWO_DEVICES = ControllerSettings(devices=("00000001", "00000002"))
+
+
+@pytest.mark.parametrize(
+    "settings,locations,ready_devices,expected_locations,output",
+    [
+        (
+            SETTINGS_ONE_DEVICE,
+            "1:0.5,0.5",
+            ["1"],
+            {"00000001": ResetLocation(pos_x=0, pos_y=0)},
+            "",
+        ),
+        (
+            SETTINGS_TWO_DEVICES,
+            "1:0.5,1500.2-2:200,100",
+            ["1", "2"],
+            {
+                "00000001": ResetLocation(pos_x=0, pos_y=1500),
+                "00000002": ResetLocation(pos_x=200, pos_y=100),
+            },
+            "",
+        ),
+        (
+            SETTINGS_ONE_DEVICE,
+            "2:0.5,0.5",
+            ["1"],
+            None,
+            "Selected devices and reset locations do not match",
+        ),
+        (SETTINGS_NO_DEVICE, "1:0.5,0.5", ["1"], None, "No device selected"),
+        (SETTINGS_ONE_DEVICE, "1:0.5,0.5", [], None, "No device to reset"),
+    ],
+)
+def test_reset(
+    runner,
+    main_cmd,
+    controller,
+    settings,
+    locations,
+    ready_devices,
+    expected_locations,
+    output,
+):
+    controller.settings = settings
+    controller.ready_devices = ready_devices
+    result = runner.invoke(main_cmd, ["reset", locations])
     assert result.exit_code == 0
-    assert "No device selected" in result.output
-    controller.reset.assert_not_called()
-    controller.terminate.assert_called_once()
+    assert output in result.output
+    if expected_locations is None:
+        assert not controller.calls["reset"]
+    else:
+        assert controller.calls["reset"] == [((expected_locations,), {})]
 
 
-@patch("swarmit.cli.main.Controller")
-def test_reset_no_device_ready(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
-    type(controller_mock.return_value).settings = PropertyMock(
-        return_value=ControllerSettings(devices=[1])
-    )
-    type(controller_mock.return_value).ready_devices = PropertyMock(
-        return_value=[]
+def test_reset_devices_option(runner, main_cmd, controller):
+    controller.ready_devices = ["00000001", "00000002"]
+    result = runner.invoke(
+        main_cmd, ["-d", "00000001,00000002", "reset", "1:10,20-2:30,40"]
     )
-    result = runner.invoke(main, ["reset", "1:0.5,0.5"])
     assert result.exit_code == 0
-    assert "No device to reset" in result.output
-    controller.reset.assert_not_called()
-    controller.terminate.assert_called_once()
+    assert "do not match" not in result.output
+    assert controller.calls["reset"] == [
+        (
+            (
+                {
+                    "00000001": ResetLocation(pos_x=10, pos_y=20),
+                    "00000002": ResetLocation(pos_x=30, pos_y=40),
+                },
+            ),
+            {},
+        )
+    ]
 
 
 @pytest.fixture
 def fw(tmp_path):
     fw_path = tmp_path / "fw.bin"
     fw_path.write_bytes(b"firmware")
-    return fw_path
+    return SimpleNamespace(path=fw_path, bytes=b"firmware")
 
 
-@patch("swarmit.cli.main.Controller")
-def test_flash_missing_firmware(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
-    result = runner.invoke(main, ["flash"])
+@pytest.mark.no_terminate
+def test_flash_missing_firmware(runner, main_cmd, controller):
+    result = runner.invoke(main_cmd, ["flash"])
     assert result.exit_code == 1
     assert "Missing firmware file" in result.output
-    controller.start_ota.assert_not_called()
-    controller.transfer.assert_not_called()
+    assert not controller.calls["start_ota"]
+    assert not controller.calls["transfer"]
 
 
-@patch("swarmit.cli.main.Controller")
-def test_flash_no_device_ready(controller_mock, fw):
-    runner = CliRunner()
-    controller = controller_mock()
-    type(controller_mock.return_value).ready_devices = PropertyMock(
-        return_value=[]
-    )
-    result = runner.invoke(main, ["flash", str(fw)])
+def test_flash_no_device_ready(runner, main_cmd, controller, fw):
+    controller.ready_devices = []
+    result = runner.invoke(main_cmd, ["flash", str(fw.path)])
     assert result.exit_code == 1
     assert "No ready device found. Exiting" in result.output
-    controller.start_ota.assert_not_called()
-    controller.transfer.assert_not_called()
+    assert not controller.calls["start_ota"]
+    assert not controller.calls["transfer"]
 
 
-@patch("swarmit.cli.main.Controller")
-def test_flash_user_abort(controller_mock, fw):
-    runner = CliRunner()
-    controller = controller_mock()
-    result = runner.invoke(main, ["flash", str(fw)], input="n\n")
+@pytest.mark.no_terminate
+def test_flash_user_abort(runner, main_cmd, controller, fw):
+    result = runner.invoke(main_cmd, ["flash", str(fw.path)], input="n\n")
     assert "Do you want to continue?" in result.output
     assert "Abort" in result.output
     assert result.exit_code == 1
-    controller.start_ota.assert_not_called()
-    controller.transfer.assert_not_called()
-
-
-@patch("swarmit.cli.main.Controller")
-def test_flash_missing_ota_ack(controller_mock, fw):
-    runner = CliRunner()
-    controller = controller_mock()
-    result = runner.invoke(main, ["flash", str(fw)], input="y\n")
-    assert "acknowledgments are missing" in result.output
-    assert result.exit_code == 1
-    controller.start_ota.assert_called_with(fw.read_bytes())
-    controller.stop.assert_called_once()
-    controller.terminate.assert_called_once()
-    controller.transfer.assert_not_called()
+    assert not controller.calls["start_ota"]
+    assert not controller.calls["transfer"]
 
 
-@patch("swarmit.cli.main.Controller")
-def test_flash_transfer_failed(controller_mock, fw):
-    runner = CliRunner()
-    controller = controller_mock()
-    controller.start_ota.return_value = {
-        "missed": [],
-        "acked": ["1"],
+def test_flash_missing_ota_ack(runner, main_cmd, controller, fw):
+    controller.return_values["start_ota"] = {
+        "missed": ["1"],
+        "acked": [],
         "ota": StartOtaData(),
     }
-    controller.transfer.return_value = {
-        "1": TransferDataStatus(success=False),
-    }
-    result = runner.invoke(main, ["flash", str(fw)], input="y\n")
+    result = runner.invoke(main_cmd, ["flash", str(fw.path)], input="y\n")
+    assert "acknowledgments are missing" in result.output
     assert result.exit_code == 1
-    controller.start_ota.assert_called_with(fw.read_bytes())
-    controller.stop.assert_not_called()
-    controller.terminate.assert_called_once()
-    controller.transfer.assert_called_with(
-        fw.read_bytes(), controller_mock().start_ota.return_value["acked"]
-    )
-
-
-@patch("swarmit.cli.main.Controller")
-def test_flash_transfer_success_no_start(controller_mock, fw):
-    runner = CliRunner()
-    controller = controller_mock()
-    controller.start_ota.return_value = {
-        "missed": [],
-        "acked": ["1"],
-        "ota": StartOtaData(),
-    }
-    controller.transfer.return_value = {
-        "1": TransferDataStatus(success=True),
-    }
-    result = runner.invoke(main, ["flash", str(fw)], input="y\n")
-    assert result.exit_code == 0
-    controller.start_ota.assert_called_with(fw.read_bytes())
-    controller.stop.assert_not_called()
-    controller.terminate.assert_called_once()
-    controller.transfer.assert_called_with(
-        fw.read_bytes(), controller_mock().start_ota.return_value["acked"]
-    )
-
-
-@patch("swarmit.cli.main.Controller")
-def test_flash_transfer_success_with_start(controller_mock, fw):
-    runner = CliRunner()
-    controller = controller_mock()
-    controller.start_ota.return_value = {
+    assert controller.calls["start_ota"] == [
+        ((fw.bytes,), {"fw_hash": hashlib.sha256(fw.bytes).digest()})
+    ]
+    assert len(controller.calls["stop"]) == 1
+    assert not controller.calls["transfer"]
+
+
+@pytest.mark.parametrize(
+    "success,main_args,flash_args,exit_code,started",
+    [
+        (False, [], [], 1, False),
+        (True, [], [], 0, False),
+        (True, [], ["--start"], 0, True),
+        (True, ["-v"], [], 0, False),
+    ],
+)
+def test_flash_transfer(
+    runner,
+    main_cmd,
+    controller,
+    fw,
+    success,
+    main_args,
+    flash_args,
+    exit_code,
+    started,
+):
+    controller.return_values["start_ota"] = {
         "missed": [],
         "acked": ["1"],
         "ota": StartOtaData(),
     }
-    controller.transfer.return_value = {
-        "1": TransferDataStatus(success=True),
+    controller.return_values["transfer"] = {
+        "1": TransferDataStatus(success=success),
     }
-    result = runner.invoke(main, ["flash", str(fw), "--start"], input="y\n")
-    assert result.exit_code == 0
-    controller.start_ota.assert_called_with(fw.read_bytes())
-    controller.stop.assert_not_called()
-    controller.terminate.assert_called_once()
-    controller.transfer.assert_called_with(
-        fw.read_bytes(), controller_mock().start_ota.return_value["acked"]
+    result = runner.invoke(
+        main_cmd,
+        [*main_args, "flash", str(fw.path), *flash_args],
+        input="y\n",
     )
-    controller.start.assert_called_once()
+    assert result.exit_code == exit_code
+    assert controller.calls["start_ota"] == [
+        ((fw.bytes,), {"fw_hash": hashlib.sha256(fw.bytes).digest()})
+    ]
+    assert not controller.calls["stop"]
+    assert controller.calls["transfer"] == [((fw.bytes, ["1"]), {})]
+    assert bool(controller.calls["start"]) is started
 
 
-@patch("swarmit.cli.main.Controller")
-def test_monitor(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
-    result = runner.invoke(main, ["monitor"])
-    assert result.exit_code == 0
-    controller.monitor.assert_called_once()
-    controller.terminate.assert_called_once()
+def test_monitor(controller):
+    invoke_direct("monitor")
+    assert len(controller.calls["monitor"]) == 1
 
 
-@patch("swarmit.cli.main.Controller")
-def test_monitor_keyboard_interrupt(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
-    controller.monitor.side_effect = KeyboardInterrupt
-    result = runner.invoke(main, ["monitor"])
-    assert result.exit_code == 0
-    controller.terminate.assert_called_once()
+def test_monitor_keyboard_interrupt(controller):
+    controller.side_effects["monitor"] = KeyboardInterrupt
+    assert "Stopping monitor." in invoke_direct("monitor")
 
 
-@patch("swarmit.cli.main.Controller")
-def test_status(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
-    result = runner.invoke(main, ["status"])
-    assert result.exit_code == 0
-    controller.status.assert_called_once()
-    controller.terminate.assert_called_once()
+def test_status(controller):
+    invoke_direct("status")
+    assert controller.calls["status"] == [((), {"watch": False})]
 
 
-@patch("swarmit.cli.main.Controller")
-def test_status_watch(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
-    result = runner.invoke(main, ["status", "-w"])
-    assert result.exit_code == 0
-    controller.status.assert_called_with(watch=True)
-    controller.terminate.assert_called_once()
+def test_status_watch(controller):
+    invoke_direct("status", watch=True)
+    assert controller.calls["status"] == [((), {"watch": True})]
 
 
 TEST_CONFIG_TOML = """
@@ -338,26 +369,18 @@ devices = ""
 """
 
 
-@patch("swarmit.cli.main.Controller")
-def test_status_with_config(controller_mock, tmp_path):
+def test_status_with_config(runner, main_cmd, controller, tmp_path):
     # Smoke test to verify config file is loaded
     cfg_path = tmp_path / "cfg.toml"
     cfg_path.write_text(TEST_CONFIG_TOML)
 
-    runner = CliRunner()
-    controller = controller_mock()
-    result = runner.invoke(main, ["-c", str(cfg_path), "status"])
+    result = runner.invoke(main_cmd, ["-c", str(cfg_path), "status"])
     assert result.exit_code == 0
-    controller.status.assert_called_once()
-    controller.terminate.assert_called_once()
+    assert len(controller.calls["status"]) == 1
+    assert controller.settings.serial_port == "/dev/ttyACM0"
 
 
-@patch("swarmit.cli.main.Controller")
-def test_message(controller_mock):
-    runner = CliRunner()
-    controller = controller_mock()
+def test_message(controller):
     msg = "Hello swarm"
-    result = runner.invoke(main, ["message", msg])
-    assert result.exit_code == 0
-    controller.send_message.assert_called_with(msg)
-    controller.terminate.assert_called_once()
+    invoke_direct("message", message=msg)
+    assert controller.calls["send_message"] == [((msg,), {})]
@@ -1,39 +1,83 @@
+import hashlib
 import logging
-import time
-from unittest.mock import patch
+import threading
+from unittest.mock import MagicMock
 
+import pytest
+from dotbot_utils.protocol import Packet
+from marilib.mari_protocol import Header
 from marilib.model import GatewayInfo, MariGateway
 
+from swarmit.testbed.adapter import AdapterInitError
 from swarmit.testbed.controller import (
+    CHUNK_SIZE,
     Chunk,
     Controller,
     ControllerSettings,
+    NodeStatus,
     ResetLocation,
+    TransferDataStatus,
+    build_controller_settings,
 )
 from swarmit.testbed.logger import setup_logging
-from swarmit.testbed.protocol import StatusType
+from swarmit.testbed.protocol import PayloadStatus, StatusType
 from swarmit.tests.utils import (
     ChunkAckStrategy,
     MarilibMQTTAdapterMock,
     MarilibSerialAdapterMock,
-    SwarmitNode,
+    add_nodes,
+    wait_until,
 )
 
+ADAPTER_SETTINGS = [
+    pytest.param({}, id="edge"),
+    pytest.param({"adapter": "cloud", "network_id": 42}, id="cloud"),
+]
+
+
+@pytest.fixture(scope="module", autouse=True)
+def adapter_mocks():
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
+        mp.setattr("swarmit.testbed.controller.COMMAND_ATTEMPT_DELAY", 0.1)
+        mp.setattr(
+            "swarmit.testbed.adapter.MarilibSerialAdapter",
+            MarilibSerialAdapterMock,
+        )
+        mp.setattr(
+            "swarmit.testbed.adapter.MarilibMQTTAdapter",
+            MarilibMQTTAdapterMock,
+        )
+        yield
+
+
+@pytest.fixture
+def controller_factory():
+    controllers = []
+
+    def factory(**kwargs):
+        kwargs.setdefault("adapter_wait_timeout", 0.1)
+        controller = Controller(ControllerSettings(**kwargs))
+        if controller.settings.adapter == "cloud":
+            # The cloud adapter only reaches devices behind a known gateway
+            gateway_info = GatewayInfo(
+                address=0, network_id=controller.settings.network_id
+            )
+            controller.interface.mari.gateways = {
+                0: MariGateway(info=gateway_info)
+            }
+        controllers.append(controller)
+        return controller
+
+    yield factory
+    for controller in controllers:
+        controller.terminate()
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch("swarmit.testbed.controller.INACTIVE_TIMEOUT", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_basic():
-    controller = Controller(ControllerSettings(adapter_wait_timeout=0.1))
-    test_adapter = controller.interface.mari.serial_interface
-    nodes = [
-        SwarmitNode(address=addr, adapter=test_adapter)
-        for addr in [0x01, 0x02]
-    ]
-    for node in nodes:
-        test_adapter.add_node(node)
+
+def test_controller_basic(controller_factory, monkeypatch):
+    monkeypatch.setattr("swarmit.testbed.controller.INACTIVE_TIMEOUT", 0.1)
+    controller = controller_factory()
+    _, nodes = add_nodes(controller, [0x01, 0x02])
 
     assert sorted(controller.known_devices.keys()) == [
         f"{node.address:08X}" for node in nodes
@@ -45,216 +89,122 @@ def test_controller_basic():
     assert sorted(controller.resetting_devices) == []
 
     nodes[0].status = StatusType.Running
-    time.sleep(0.5)
-    assert sorted(controller.ready_devices) == [f"{nodes[1].address:08X}"]
+    wait_until(
+        lambda: sorted(controller.ready_devices) == [f"{nodes[1].address:08X}"]
+    )
     assert sorted(controller.running_devices) == [f"{nodes[0].address:08X}"]
     assert sorted(controller.resetting_devices) == []
 
     nodes[1].status = StatusType.Resetting
-    time.sleep(0.5)
-    assert sorted(controller.ready_devices) == []
+    wait_until(lambda: sorted(controller.ready_devices) == [])
     assert sorted(controller.resetting_devices) == [f"{nodes[1].address:08X}"]
     assert sorted(controller.running_devices) == [f"{nodes[0].address:08X}"]
 
     nodes[0].enabled = False
-    time.sleep(1.5)
 
+    def only_enabled_node_left():
+        # Keep the enabled node active, the disabled one stops reporting
+        nodes[1].emit_status()
+        return list(controller.status_data.keys()) == [
+            f"{nodes[1].address:08X}"
+        ]
+
+    wait_until(only_enabled_node_left)
     assert list(controller.known_devices.keys()) == [f"{nodes[1].address:08X}"]
 
-    controller.terminate()
 
+def test_controller_adapter_init_retries(controller_factory, monkeypatch):
+    monkeypatch.setattr(
+        "swarmit.testbed.controller.ADAPTER_INIT_RETRY_DELAY", 0
+    )
+    adapter_mock = MagicMock()
+    monkeypatch.setattr(
+        "swarmit.testbed.controller.MarilibEdgeAdapter", adapter_mock
+    )
+    adapter_mock.side_effect = [AdapterInitError("init failed"), MagicMock()]
+    controller_factory()
+    assert adapter_mock.call_count == 2
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch("swarmit.testbed.controller.COMMAND_ATTEMPT_DELAY", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_start_broadcast():
-    controller = Controller(ControllerSettings(adapter_wait_timeout=0.1))
-    test_adapter = controller.interface.mari.serial_interface
-    nodes = [
-        SwarmitNode(address=addr, adapter=test_adapter)
-        for addr in [0x01, 0x02]
-    ]
-    for node in nodes:
-        test_adapter.add_node(node)
+    adapter_mock.reset_mock()
+    adapter_mock.side_effect = AdapterInitError("init failed")
+    with pytest.raises(AdapterInitError, match="init failed"):
+        Controller(ControllerSettings(adapter_wait_timeout=0.1))
+    assert adapter_mock.call_count == 3
 
-    controller.start(timeout=0.1)
-    time.sleep(0.3)
-    assert all([node.status == StatusType.Running for node in nodes]) is True
 
+@pytest.mark.parametrize("settings", ADAPTER_SETTINGS)
+def test_controller_start_broadcast(controller_factory, settings):
+    controller = controller_factory(**settings)
+    _, nodes = add_nodes(controller, [0x01, 0x02])
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch("swarmit.testbed.controller.COMMAND_ATTEMPT_DELAY", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_start_unicast():
-    controller = Controller(ControllerSettings(adapter_wait_timeout=0.1))
-    test_adapter = controller.interface.mari.serial_interface
-    nodes = [
-        SwarmitNode(address=addr, adapter=test_adapter)
-        for addr in [0x01, 0x02]
-    ]
-    node3 = SwarmitNode(
-        address=0x03, status=StatusType.Running, adapter=test_adapter
+    controller.start(timeout=0.1)
+    wait_until(
+        lambda: all(node.status == StatusType.Running for node in nodes)
     )
-    nodes.append(node3)
 
-    for node in nodes:
-        test_adapter.add_node(node)
+
+def test_controller_start_unicast(controller_factory):
+    controller = controller_factory()
+    _, nodes = add_nodes(
+        controller,
+        [0x01, 0x02, 0x03],
+        statuses=[StatusType.Bootloader] * 2 + [StatusType.Running],
+    )
 
     assert sorted(controller.known_devices.keys()) == [
         f"{node.address:08X}" for node in nodes
     ]
 
     controller.start(devices=["00000001", "00000003"], timeout=0.1)
-    time.sleep(0.3)
-    assert nodes[0].status == StatusType.Running
+    wait_until(lambda: nodes[0].status == StatusType.Running)
     assert nodes[1].status == StatusType.Bootloader
     assert nodes[2].status == StatusType.Running
 
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch("swarmit.testbed.controller.COMMAND_ATTEMPT_DELAY", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibMQTTAdapter",
-    MarilibMQTTAdapterMock,
-)
-def test_controller_start_broadcast_cloud_adapter():
-    controller = Controller(
-        ControllerSettings(
-            adapter="cloud", network_id=42, adapter_wait_timeout=0.1
-        )
+def test_controller_stop_broadcast(controller_factory):
+    controller = controller_factory()
+    _, nodes = add_nodes(
+        controller, [0x01, 0x02], statuses=[StatusType.Running] * 2
     )
-    controller.interface.mari.gateways = {
-        0: MariGateway(info=GatewayInfo(address=0, network_id=42))
-    }
-    test_adapter = controller.interface.mari.mqtt_interface
-    nodes = [
-        SwarmitNode(address=addr, adapter=test_adapter)
-        for addr in [0x01, 0x02]
-    ]
-    for node in nodes:
-        test_adapter.add_node(node)
-
-    controller.start(timeout=0.1)
-    time.sleep(0.3)
-    assert all([node.status == StatusType.Running for node in nodes]) is True
-
-
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch("swarmit.testbed.controller.COMMAND_ATTEMPT_DELAY", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_stop_broadcast():
-    controller = Controller(ControllerSettings(adapter_wait_timeout=0.1))
-    test_adapter = controller.interface.mari.serial_interface
-    nodes = [
-        SwarmitNode(
-            address=addr, status=StatusType.Running, adapter=test_adapter
-        )
-        for addr in [0x01, 0x02]
-    ]
-    for node in nodes:
-        test_adapter.add_node(node)
 
     controller.stop(timeout=0.1)
-    time.sleep(0.3)
-    assert (
-        all([node.status == StatusType.Bootloader for node in nodes]) is True
+    wait_until(
+        lambda: all(node.status == StatusType.Bootloader for node in nodes)
     )
 
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch("swarmit.testbed.controller.COMMAND_ATTEMPT_DELAY", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_stop_unicast():
-    controller = Controller(ControllerSettings(adapter_wait_timeout=0.1))
-    test_adapter = controller.interface.mari.serial_interface
-    nodes = [
-        SwarmitNode(
-            address=addr, status=StatusType.Running, adapter=test_adapter
-        )
-        for addr in [0x01, 0x02]
-    ]
-    node3 = SwarmitNode(address=0x03, adapter=test_adapter)
-    nodes.append(node3)
-
-    for node in nodes:
-        test_adapter.add_node(node)
+def test_controller_stop_unicast(controller_factory):
+    controller = controller_factory()
+    _, nodes = add_nodes(
+        controller,
+        [0x01, 0x02, 0x03],
+        statuses=[StatusType.Running] * 2 + [StatusType.Bootloader],
+    )
 
     assert sorted(controller.known_devices.keys()) == [
         f"{node.address:08X}" for node in nodes
     ]
 
     controller.stop(devices=["00000001", "00000003"], timeout=0.1)
-    time.sleep(0.3)
-    assert nodes[0].status == StatusType.Bootloader
+    wait_until(
+        lambda: nodes[0].status == nodes[2].status == StatusType.Bootloader
+    )
     assert nodes[1].status == StatusType.Running
     assert nodes[2].status == StatusType.Bootloader
 
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_status(capsys):
-    controller = Controller(ControllerSettings(adapter_wait_timeout=0.1))
-    test_adapter = controller.interface.mari.serial_interface
-    controller.status(timeout=0.1)
-    out, _ = capsys.readouterr()
-    assert "No device found" in out
-
-    node1 = SwarmitNode(address=0x01, adapter=test_adapter)
-    node2 = SwarmitNode(address=0x02, adapter=test_adapter, battery=2100)
-    node3 = SwarmitNode(address=0x03, adapter=test_adapter, battery=1500)
-    nodes = [node1, node2, node3]
-    for node in nodes:
-        test_adapter.add_node(node)
-
-    controller.status(timeout=0.1)
-    out, _ = capsys.readouterr()
-    assert "3 devices found" in out
-    assert f"{node1.address:08X}" in out
-    assert f"{node2.address:08X}" in out
-    assert f"{node3.address:08X}" in out
-    assert f"{2500/1000:.2f}V" in out
-    assert f"{2100/1000:.2f}V" in out
-    assert f"{1500/1000:.2f}V" in out
-
-
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibMQTTAdapter",
-    MarilibMQTTAdapterMock,
-)
-def test_controller_status_adpater_cloud(capsys):
-    controller = Controller(
-        ControllerSettings(
-            adapter="cloud", network_id=42, adapter_wait_timeout=0.1
-        )
-    )
-    controller.interface.mari.gateways = {
-        0: MariGateway(info=GatewayInfo(address=0, network_id=42))
-    }
-    test_adapter = controller.interface.mari.mqtt_interface
+@pytest.mark.parametrize("settings", ADAPTER_SETTINGS)
+def test_controller_status(controller_factory, settings, capsys):
+    controller = controller_factory(**settings)
     controller.status(timeout=0.1)
     out, _ = capsys.readouterr()
     assert "No device found" in out
 
-    node1 = SwarmitNode(address=0x01, adapter=test_adapter)
-    node2 = SwarmitNode(address=0x02, adapter=test_adapter, battery=2100)
-    node3 = SwarmitNode(address=0x03, adapter=test_adapter, battery=1500)
-    nodes = [node1, node2, node3]
-    for node in nodes:
-        test_adapter.add_node(node)
+    _, (node1,) = add_nodes(controller, [0x01])
+    _, (node2,) = add_nodes(controller, [0x02], battery=2100)
+    _, (node3,) = add_nodes(controller, [0x03], battery=1500)
 
     controller.status(timeout=0.1)
-    time.sleep(0.3)
     out, _ = capsys.readouterr()
     assert "3 devices found" in out
     assert f"{node1.address:08X}" in out
@@ -265,146 +215,96 @@ def test_controller_status_adpater_cloud(capsys):
     assert f"{1500/1000:.2f}V" in out
 
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_reset():
-    controller = Controller(
-        ControllerSettings(
-            devices=["00000001", "00000002"], adapter_wait_timeout=0.1
-        )
-    )
-    test_adapter = controller.interface.mari.serial_interface
-    nodes = [
-        SwarmitNode(address=addr, adapter=test_adapter)
-        for addr in [0x01, 0x02]
-    ]
-    for node in nodes:
-        test_adapter.add_node(node)
+def test_controller_reset(controller_factory):
+    controller = controller_factory(devices=["00000001", "00000002"])
+    _, nodes = add_nodes(controller, [0x01, 0x02])
     locations = {
         "00000001": ResetLocation(pos_x=1000000, pos_y=2000),
         "00000002": ResetLocation(pos_x=2000000, pos_y=1000),
     }
     controller.reset(locations=locations)
-    time.sleep(0.3)
+    wait_until(
+        lambda: sorted(controller.resetting_devices)
+        == ["00000001", "00000002"]
+    )
     for node in nodes:
         assert node.status == StatusType.Resetting
     controller.stop(timeout=0.1)
-    time.sleep(0.3)
-    assert (
-        all([node.status == StatusType.Bootloader for node in nodes]) is True
+    wait_until(
+        lambda: all(node.status == StatusType.Bootloader for node in nodes)
     )
 
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_reset_not_ready():
-    controller = Controller(
-        ControllerSettings(
-            devices=["00000001", "00000002"], adapter_wait_timeout=0.1
-        )
-    )
-    test_adapter = controller.interface.mari.serial_interface
-    node1 = SwarmitNode(address=0x01, adapter=test_adapter)
-    node2 = SwarmitNode(
-        address=0x02, status=StatusType.Running, adapter=test_adapter
+def test_controller_reset_not_ready(controller_factory):
+    controller = controller_factory(devices=["00000001", "00000002"])
+    _, (node1, node2) = add_nodes(
+        controller,
+        [0x01, 0x02],
+        statuses=[StatusType.Bootloader, StatusType.Running],
     )
-    nodes = [node1, node2]
-
-    for node in nodes:
-        test_adapter.add_node(node)
     locations = {
         "00000001": ResetLocation(pos_x=1000000, pos_y=2000),
         "00000002": ResetLocation(pos_x=2000000, pos_y=1000),
     }
     controller.reset(locations=locations)
-    time.sleep(0.3)
+    wait_until(lambda: controller.resetting_devices == ["00000001"])
     assert node1.status == StatusType.Resetting
     assert node2.status == StatusType.Running
 
     controller.stop(timeout=0.1)
-    time.sleep(0.3)
-    assert node1.status == StatusType.Bootloader
-    assert node2.status == StatusType.Bootloader
+    wait_until(lambda: node1.status == node2.status == StatusType.Bootloader)
 
 
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_monitor(caplog):
-    caplog.set_level(logging.INFO)
-    setup_logging()
-    controller = Controller(ControllerSettings(adapter_wait_timeout=0.1))
+def log_events(caplog):
+    """Return the events and the device log data captured by caplog."""
+    events = set()
+    for record in caplog.records:
+        # structlog hands the event dict over to the logging record
+        if isinstance(record.msg, dict):
+            events.add(record.msg["event"])
+            if "data" in record.msg:
+                events.add(record.msg["data"])
+    return events
 
-    controller.monitor(run_forever=False, timeout=0.1)
-    assert "Monitoring testbed" in caplog.text
 
-    test_adapter = controller.interface.mari.serial_interface
-    nodes = [
-        SwarmitNode(address=addr, adapter=test_adapter)
-        for addr in [0x01, 0x02]
-    ]
+def test_controller_monitor(controller_factory, caplog):
+    caplog.set_level(logging.INFO)
+    setup_logging()
+    controller = controller_factory()
+    _, nodes = add_nodes(controller, [0x01, 0x02])
     for node in nodes:
-        test_adapter.add_node(node)
-        node.start_log_event_task()
+        node.emit_log_event()
 
     controller.monitor(run_forever=False, timeout=0.1)
-    assert "Monitoring testbed" in caplog.text
+    events = log_events(caplog)
+    assert "Monitoring testbed" in events
     for node in nodes:
-        assert f"Node {node.address:08X} log event" in caplog.text
-    controller.terminate()
+        assert f"Node {node.address:08X} log event".encode() in events
 
 
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_monitor_single_device(caplog):
+def test_controller_monitor_single_device(controller_factory, caplog):
     caplog.set_level(logging.INFO)
     setup_logging()
-    controller = Controller(
-        ControllerSettings(devices=["00000001"], adapter_wait_timeout=0.1)
-    )
+    controller = controller_factory(devices=["00000001"])
 
-    test_adapter = controller.interface.mari.serial_interface
-    nodes = [
-        SwarmitNode(address=addr, adapter=test_adapter)
-        for addr in [0x01, 0x02]
-    ]
+    _, nodes = add_nodes(controller, [0x01, 0x02])
     for node in nodes:
-        test_adapter.add_node(node)
-        node.start_log_event_task()
+        node.emit_log_event()
 
     controller.monitor(run_forever=False, timeout=0.1)
-    assert "Monitoring testbed" in caplog.text
-    assert "Node 00000001 log event" in caplog.text
-    assert "Node 00000002 log event" not in caplog.text
-    controller.terminate()
-
-
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_send_message_unicast(capsys):
-    controller = Controller(
-        ControllerSettings(
-            devices=["00000001", "00000003"], adapter_wait_timeout=0.1
-        )
+    events = log_events(caplog)
+    assert "Monitoring testbed" in events
+    assert b"Node 00000001 log event" in events
+    assert b"Node 00000002 log event" not in events
+
+
+def test_controller_send_message_unicast(controller_factory, capsys):
+    controller = controller_factory(devices=["00000001", "00000003"])
+    _, nodes = add_nodes(
+        controller,
+        [0x01, 0x02, 0x03],
+        statuses=[StatusType.Running] * 2 + [StatusType.Bootloader],
     )
-    test_adapter = controller.interface.mari.serial_interface
-    nodes = [
-        SwarmitNode(
-            address=addr, status=StatusType.Running, adapter=test_adapter
-        )
-        for addr in [0x01, 0x02]
-    ]
-    node3 = SwarmitNode(address=0x03, adapter=test_adapter)
-    nodes.append(node3)
-    for node in nodes:
-        test_adapter.add_node(node)
 
     controller.send_message("Hello robot!")
     out, _ = capsys.readouterr()
@@ -412,21 +312,11 @@ def test_controller_send_message_unicast(capsys):
     assert "Node 00000003 received message: Hello robot!" not in out
 
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_send_message_broadcast(capsys):
-    controller = Controller(ControllerSettings(adapter_wait_timeout=0.1))
-    test_adapter = controller.interface.mari.serial_interface
-    nodes = [
-        SwarmitNode(
-            address=addr, status=StatusType.Running, adapter=test_adapter
-        )
-        for addr in [0x01, 0x02]
-    ]
-    for node in nodes:
-        test_adapter.add_node(node)
+def test_controller_send_message_broadcast(controller_factory, capsys):
+    controller = controller_factory()
+    _, nodes = add_nodes(
+        controller, [0x01, 0x02], statuses=[StatusType.Running] * 2
+    )
 
     controller.send_message("Hello robot!")
     out, _ = capsys.readouterr()
@@ -434,22 +324,12 @@ def test_controller_send_message_broadcast(capsys):
         assert f"Node {node} received message: Hello robot!" in out
 
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch("swarmit.testbed.controller.OTA_ACK_TIMEOUT_DEFAULT", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_ota_broadcast():
-    controller = Controller(ControllerSettings(adapter_wait_timeout=0.1))
-    test_adapter = controller.interface.mari.serial_interface
-    nodes = [
-        SwarmitNode(address=addr, adapter=test_adapter)
-        for addr in [0x01, 0x02]
-    ]
-    for node in nodes:
-        test_adapter.add_node(node)
+@pytest.mark.parametrize("verbose", [False, True])
+def test_controller_ota_broadcast(controller_factory, verbose, capsys):
+    controller = controller_factory(verbose=verbose)
+    _, nodes = add_nodes(controller, [0x01, 0x02])
 
-    firmware = b"\x00" * 2**16
+    firmware = b"\x00" * (CHUNK_SIZE * 4)
 
     ota_data = controller.start_ota(firmware)
     assert ota_data["acked"] == [f"{node.address:08X}" for node in nodes]
@@ -459,101 +339,102 @@ def test_controller_ota_broadcast():
         assert node.status == StatusType.Programming
 
     result = controller.transfer(firmware, ota_data["acked"])
-    time.sleep(0.3)
     assert all([transfer.success for transfer in result.values()]) is True
+    assert ("Transfer completed" in capsys.readouterr().out) is verbose
 
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch("swarmit.testbed.controller.OTA_ACK_TIMEOUT_DEFAULT", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_ota_broadcast_verbose(capsys):
-    controller = Controller(
-        ControllerSettings(adapter_wait_timeout=0.1, verbose=True)
-    )
-    test_adapter = controller.interface.mari.serial_interface
-    nodes = [
-        SwarmitNode(address=addr, adapter=test_adapter)
-        for addr in [0x01, 0x02]
-    ]
-    for node in nodes:
-        test_adapter.add_node(node)
+def test_controller_start_ota_precomputed_hash(controller_factory):
+    controller = controller_factory()
+    firmware = bytes(range(256)) * 10
+    expected = controller.start_ota(firmware)["ota"]
+    fw_hash = hashlib.sha256(firmware).digest()
+    ota = controller.start_ota(firmware, fw_hash=fw_hash)["ota"]
+    assert ota.fw_hash == expected.fw_hash == fw_hash
+    assert ota.chunks == expected.chunks
+
+
+def test_controller_ota_unicast(controller_factory):
+    controller = controller_factory(devices=["00000001"])
+    _, nodes = add_nodes(controller, [0x01, 0x02])
 
-    firmware = b"\x00" * 2**16
+    firmware = b"\x00" * (CHUNK_SIZE * 4) + b"\x01" * 42
 
     ota_data = controller.start_ota(firmware)
-    assert ota_data["acked"] == [f"{node.address:08X}" for node in nodes]
+    assert ota_data["acked"] == ["00000001"]
     assert ota_data["missed"] == []
 
-    for node in nodes:
-        assert node.status == StatusType.Programming
+    assert nodes[0].status == StatusType.Programming
+    assert nodes[1].status == StatusType.Bootloader
 
     result = controller.transfer(firmware, ota_data["acked"])
-    time.sleep(0.3)
     assert all([transfer.success for transfer in result.values()]) is True
-    assert "Transfer completed" in capsys.readouterr().out
 
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch("swarmit.testbed.controller.OTA_ACK_TIMEOUT_DEFAULT", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_ota_unicast():
-    controller = Controller(
-        ControllerSettings(devices=["00000001"], adapter_wait_timeout=0.1)
-    )
-    test_adapter = controller.interface.mari.serial_interface
-    nodes = [
-        SwarmitNode(address=addr, adapter=test_adapter)
-        for addr in [0x01, 0x02]
+def test_controller_send_chunk(controller_factory):
+    controller = controller_factory(devices=["00000001"])
+    _, nodes = add_nodes(controller, [0x01])
+
+    ota_data = controller.start_ota(b"\x00" * (CHUNK_SIZE * 2))
+    assert ota_data["acked"] == ["00000001"]
+    controller.transfer_data = {"00000001": TransferDataStatus()}
+    controller.transfer_data["00000001"].chunks = [
+        Chunk(index=f"{i:03d}", size=f"{CHUNK_SIZE:03d}B") for i in range(2)
     ]
-    for node in nodes:
-        test_adapter.add_node(node)
+    for chunk in controller.chunks:
+        controller.send_chunk(chunk, "00000001", {"00000001"})
+    assert all(c.acked for c in controller.transfer_data["00000001"].chunks)
+    assert nodes[0].ota.bytes_received == CHUNK_SIZE * 2
+
+
+@pytest.mark.slow
+def test_controller_ota_large_firmware(controller_factory):
+    controller = controller_factory()
+    _, nodes = add_nodes(controller, [0x01, 0x02])
 
     firmware = b"\x00" * 2**16 + b"\x01" * 1234
 
     ota_data = controller.start_ota(firmware)
-    assert ota_data["acked"] == ["00000001"]
-    assert ota_data["missed"] == []
-
-    assert nodes[0].status == StatusType.Programming
-    assert nodes[1].status == StatusType.Bootloader
+    assert ota_data["acked"] == [f"{node.address:08X}" for node in nodes]
 
     result = controller.transfer(firmware, ota_data["acked"])
-    time.sleep(0.3)
     assert all([transfer.success for transfer in result.values()]) is True
+    for node in nodes:
+        assert node.ota.bytes_received == len(firmware)
 
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch("swarmit.testbed.controller.OTA_ACK_TIMEOUT_DEFAULT", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_ota_with_retries(capsys):
-    controller = Controller(
-        ControllerSettings(
-            adapter_wait_timeout=0.1, ota_max_retries=3, verbose=True
-        )
+def test_controller_ota_window(controller_factory):
+    controller = controller_factory(
+        devices=["00000001", "00000002"], ota_window=8
     )
-    test_adapter = controller.interface.mari.serial_interface
-    node1 = SwarmitNode(
-        address=0x01,
+    _, nodes = add_nodes(controller, [0x01, 0x02])
+
+    firmware = b"\x00" * 2**12 + b"\x01" * 42
+
+    ota_data = controller.start_ota(firmware)
+    assert ota_data["acked"] == ["00000001", "00000002"]
+
+    result = controller.transfer(firmware, ota_data["acked"])
+    assert all([transfer.success for transfer in result.values()]) is True
+    for node in nodes:
+        assert node.ota.bytes_received == len(firmware)
+
+
+def test_controller_ota_with_retries(controller_factory, capsys):
+    controller = controller_factory(ota_max_retries=3, verbose=True)
+    _, (node1,) = add_nodes(
+        controller,
+        [0x01],
         ack_strategy=ChunkAckStrategy(ack_miss_index=5, ack_miss_retries=2),
-        adapter=test_adapter,
     )
-    node2 = SwarmitNode(
-        address=0x02,
+    _, (node2,) = add_nodes(
+        controller,
+        [0x02],
         ack_strategy=ChunkAckStrategy(ack_miss_index=5, ack_miss_retries=4),
         ota_should_fail=True,
-        adapter=test_adapter,
     )
     nodes = [node1, node2]
-    for node in nodes:
-        test_adapter.add_node(node)
 
-    firmware = b"\x00" * 2**16
+    firmware = b"\x00" * (CHUNK_SIZE * 55)
 
     ota_data = controller.start_ota(firmware)
     assert ota_data["acked"] == [f"{node.address:08X}" for node in nodes]
@@ -571,27 +452,16 @@ def test_controller_ota_with_retries(capsys):
     assert sum(chunk.retries for chunk in result["00000002"].chunks) == 3
 
 
-@patch("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.1)
-@patch("swarmit.testbed.controller.OTA_ACK_TIMEOUT_DEFAULT", 0.1)
-@patch(
-    "swarmit.testbed.adapter.MarilibSerialAdapter", MarilibSerialAdapterMock
-)
-def test_controller_ota_index_out_range(capsys):
-    controller = Controller(
-        ControllerSettings(
-            adapter_wait_timeout=0.1, ota_max_retries=3, verbose=True
-        )
-    )
-    test_adapter = controller.interface.mari.serial_interface
-    node = SwarmitNode(
-        address=0x01,
+def test_controller_ota_index_out_range(controller_factory, capsys):
+    controller = controller_factory(ota_max_retries=3, verbose=True)
+    _, (node,) = add_nodes(
+        controller,
+        [0x01],
         ack_strategy=ChunkAckStrategy(ack_out_of_range_index=50),
         ota_should_fail=True,
-        adapter=test_adapter,
     )
-    test_adapter.add_node(node)
 
-    firmware = b"\x00" * 2**16
+    firmware = b"\x00" * (CHUNK_SIZE * 55)
 
     ota_data = controller.start_ota(firmware)
     assert ota_data["acked"] == [f"{node.address:08X}"]
@@ -604,9 +474,163 @@ def test_controller_ota_index_out_range(capsys):
     assert sum(chunk.retries for chunk in result["00000001"].chunks) == 3
 
 
+def test_node_reset_keeps_ack_strategy(controller_factory):
+    controller = controller_factory()
+    strategy = ChunkAckStrategy(ack_miss_index=5, ack_miss_retries=2)
+    _, (node,) = add_nodes(controller, [0x01], ack_strategy=strategy)
+    node.ota.ack_strategy.ack_miss_retries = 0
+    node.reset()
+    assert node.ota.ack_strategy == strategy
+    assert node.ota.ack_strategy is not strategy
+
+
 def test_controller_chunk_repr():
     chunk = Chunk(index=42, size=128, acked=True, retries=2)
     assert (
         repr(chunk)
         == "{'index': 42, 'size': 128, 'acked': True, 'retries': 2}"
     )
+
+
+def test_build_controller_settings(monkeypatch):
+    monkeypatch.setattr(
+        "swarmit.testbed.controller.default_serial_port", lambda: "/dev/tty0"
+    )
+    config = {
+        "adapter": "cloud",
+        "serial_port": None,
+        "baudrate": 115200,
+        "mqtt_host": "example.org",
+        "mqtt_port": 8883,
+        "mqtt_use_tls": True,
+        "swarmit_network_id": "12ab",
+        "devices": "00000001,,00000002",
+        "verbose": False,
+    }
+    settings = build_controller_settings(config, map_size="100x200")
+    assert settings == ControllerSettings(
+        serial_port="/dev/tty0",
+        serial_baudrate=115200,
+        mqtt_host="example.org",
+        mqtt_port=8883,
+        mqtt_use_tls=True,
+        network_id=0x12AB,
+        adapter="cloud",
+        devices=["00000001", "00000002"],
+        map_size="100x200",
+    )
+
+
+def test_controller_settings_frozen():
+    settings = ControllerSettings(serial_port="/dev/tty0", devices=["1"])
+    assert settings.devices == ("1",)
+    assert hash(settings) == hash(
+        ControllerSettings(serial_port="/dev/tty0", devices=("1",))
+    )
+    with pytest.raises(AttributeError):
+        settings.verbose = True
+
+
+def test_controller_status_version(controller_factory):
+    controller = controller_factory()
+    version = controller.status_version
+    controller.status_data["00000001"] = NodeStatus(last_updated_at=0)
+    controller.cleanup_inactive(1)
+    assert controller.status_data == {}
+    assert controller.status_version == version + 1
+    controller.cleanup_inactive(1)
+    assert controller.status_version == version + 1
+
+    def receive_status(battery):
+        controller.on_frame_received(
+            Header(source=0x01),
+            Packet.from_payload(PayloadStatus(battery=battery)),
+        )
+
+    receive_status(2500)
+    assert controller.status_version == version + 2
+    # a report identical to the previous one only refreshes the update time
+    updated_at = controller.status_data["00000001"].last_updated_at
+    receive_status(2500)
+    assert controller.status_version == version + 2
+    assert controller.status_data["00000001"].last_updated_at >= updated_at
+    receive_status(2400)
+    assert controller.status_version == version + 3
+
+
+def test_controller_devices_with_status(controller_factory):
+    controller = controller_factory(devices=["00000001", "00000002"])
+
+    def receive_status(address, status):
+        controller.on_frame_received(
+            Header(source=address),
+            Packet.from_payload(PayloadStatus(device=1, status=status.value)),
+        )
+
+    receive_status(0x01, StatusType.Bootloader)
+    receive_status(0x02, StatusType.Running)
+    receive_status(0x03, StatusType.Bootloader)
+    assert controller.devices_with_status(StatusType.Bootloader) == {
+        "00000001",
+        "00000003",
+    }
+    # only selected devices are returned by the properties
+    assert controller.ready_devices == ["00000001"]
+    assert controller.running_devices == ["00000002"]
+
+    receive_status(0x01, StatusType.Programming)
+    assert controller.ready_devices == []
+    assert controller.devices_with_status(
+        StatusType.Running, StatusType.Programming
+    ) == {"00000001", "00000002"}
+
+    controller.status_data["00000001"].last_updated_at = 0
+    controller.cleanup_inactive(1)
+    assert controller.running_devices == ["00000002"]
+
+
+def test_controller_cleanup_concurrent_status(controller_factory):
+    controller = controller_factory()
+    receivers = []
+
+    def receive_status(status):
+        controller.on_frame_received(
+            Header(source=0x01),
+            Packet.from_payload(PayloadStatus(status=status.value)),
+        )
+
+    class RacyStatusData(dict):
+        def _switch_status(self):
+            # The device switches to running while it's being removed
+            receiver = threading.Thread(
+                target=receive_status, args=(StatusType.Running,)
+            )
+            receiver.start()
+            receiver.join(0.1)
+            receivers.append(receiver)
+
+        def pop(self, key, *args):
+            self._switch_status()
+            return super().pop(key, *args)
+
+        def __delitem__(self, key):
+            self._switch_status()
+            super().__delitem__(key)
+
+    def assert_indexed_once():
+        status = controller.status_data.get("00000001")
+        assert [
+            candidate
+            for candidate in StatusType
+            if "00000001" in controller.devices_with_status(candidate)
+        ] == ([status.status] if status is not None else [])
+
+    controller.status_data = RacyStatusData()
+    receive_status(StatusType.Bootloader)
+    controller.cleanup_inactive(-1)
+    for receiver in receivers:
+        receiver.join()
+    assert_indexed_once()
+
+    receive_status(StatusType.Bootloader)
+    assert_indexed_once()
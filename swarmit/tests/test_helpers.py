@@ -1,4 +1,8 @@
-from swarmit.testbed.helpers import load_toml_config
+from swarmit.testbed.helpers import (
+    default_serial_port,
+    load_toml_config,
+    merge_config,
+)
 
 TEST_CONFIG_TOML = """
 adapter = "edge"
@@ -21,3 +25,55 @@ def test_load_toml_config(tmp_path):
 def test_load_toml_config_empty():
     cfg = load_toml_config("")
     assert cfg == {}
+
+
+def test_load_toml_config_reloaded_on_change(tmp_path):
+    cfg_path = tmp_path / "cfg.toml"
+    cfg_path.write_text(TEST_CONFIG_TOML)
+    assert load_toml_config(str(cfg_path))["adapter"] == "edge"
+    # cached result is a copy, altering it doesn't affect the next call
+    load_toml_config(str(cfg_path))["adapter"] = "other"
+    assert load_toml_config(str(cfg_path))["adapter"] == "edge"
+
+    cfg_path.write_text(TEST_CONFIG_TOML.replace("edge", "cloud"))
+    assert load_toml_config(str(cfg_path))["adapter"] == "cloud"
+
+
+def test_load_toml_config_without_rtoml(tmp_path, monkeypatch):
+    monkeypatch.setattr("swarmit.testbed.helpers.rtoml", None)
+    cfg_path = tmp_path / "cfg.toml"
+    cfg_path.write_text(TEST_CONFIG_TOML)
+    cfg = load_toml_config(str(cfg_path))
+    assert cfg["adapter"] == "edge"
+    assert cfg["baudrate"] == 1000000
+
+
+def test_default_serial_port(monkeypatch):
+    default_serial_port.cache_clear()
+    calls = []
+
+    def get_default_port():
+        calls.append(True)
+        return "/dev/ttyTEST"
+
+    monkeypatch.setattr(
+        "swarmit.testbed.helpers.get_default_port", get_default_port
+    )
+    assert default_serial_port() == "/dev/ttyTEST"
+    assert default_serial_port() == "/dev/ttyTEST"
+    # serial ports are only enumerated once
+    assert len(calls) == 1
+    default_serial_port.cache_clear()
+
+
+def test_merge_config():
+    defaults = {"adapter": "edge", "baudrate": 1000000, "verbose": False}
+    config = merge_config(
+        defaults,
+        {"adapter": "cloud", "baudrate": None},
+        {"adapter": "edge", "baudrate": 115200, "verbose": False},
+    )
+    assert config == {"adapter": "edge", "baudrate": 115200, "verbose": False}
+    config = merge_config(defaults, {"adapter": "cloud"}, {"adapter": None})
+    assert config["adapter"] == "cloud"
+    assert defaults["adapter"] == "edge"
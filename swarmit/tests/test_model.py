@@ -1,38 +1,56 @@
+import concurrent.futures
 import datetime
 
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.orm import sessionmaker
 
 from swarmit.testbed.model import (
     AwareDateTime,
     Base,
     JWTRecord,
+    create_db_engine,
     create_prevent_overlap_trigger,
 )
 
 
-@pytest.fixture(scope="function")
-def db_session():
-    """Creates an isolated in-memory SQLite DB with triggers installed."""
+@pytest.fixture(scope="module")
+def db_engine():
+    """Creates an in-memory SQLite DB with triggers installed."""
     engine = create_engine(
         "sqlite:///:memory:", connect_args={"check_same_thread": False}
     )
-    TestingSessionLocal = sessionmaker(bind=engine)
 
-    # Recreate schema
-    Base.metadata.create_all(bind=engine)
+    # Let SQLAlchemy emit BEGIN itself, pysqlite would otherwise defer it
+    # and the savepoints used by db_session would not be rolled back.
+    @event.listens_for(engine, "connect")
+    def disable_pysqlite_transactions(dbapi_connection, _):
+        dbapi_connection.isolation_level = None
 
-    # Recreate triggers
-    with engine.connect() as conn:
+    @event.listens_for(engine, "begin")
+    def begin_transaction(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
         create_prevent_overlap_trigger(conn)
+    yield engine
+    engine.dispose()
 
-    session = TestingSessionLocal()
-    try:
-        yield session
-    finally:
-        session.close()
-        engine.dispose()
+
+@pytest.fixture
+def db_session(db_engine):
+    """Session in a transaction rolled back at teardown, commits included."""
+    with db_engine.connect() as conn:
+        transaction = conn.begin()
+        session = sessionmaker(
+            bind=conn, join_transaction_mode="create_savepoint"
+        )()
+        try:
+            yield session
+        finally:
+            session.close()
+            transaction.rollback()
 
 
 def test_aware_datetime_assigns_utc_on_bind():
@@ -77,6 +95,22 @@ def test_insert_non_overlapping_ranges(db_session):
     assert db_session.query(JWTRecord).count() == 2
 
 
+def test_insert_many_non_overlapping(db_session):
+    base = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    records = [
+        JWTRecord(
+            jwt=f"token{i}",
+            date_start=base + datetime.timedelta(days=2 * i),
+            date_end=base + datetime.timedelta(days=2 * i + 1),
+        )
+        for i in range(1000)
+    ]
+    db_session.bulk_save_objects(records)
+    db_session.commit()
+
+    assert db_session.query(JWTRecord).count() == 1000
+
+
 def test_insert_overlapping_fails(db_session):
     start1 = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
     end1 = datetime.datetime(2024, 1, 5, tzinfo=datetime.timezone.utc)
@@ -153,3 +187,34 @@ def test_update_non_overlapping_succeeds(db_session):
     db_session.commit()  # Should not raise
 
     assert db_session.query(JWTRecord).count() == 2
+
+
+def test_create_db_engine(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path}/database.db")
+    Base.metadata.create_all(bind=engine)
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+        assert conn.execute(text("PRAGMA temp_store")).scalar() == 2
+    indexed_columns = [
+        index["column_names"]
+        for index in inspect(engine).get_indexes("jwt_records")
+    ]
+    assert ["date_start"] in indexed_columns
+    assert ["date_end"] in indexed_columns
+    engine.dispose()
+
+
+def test_create_db_engine_in_memory():
+    engine = create_db_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+
+    def count_records():
+        with engine.connect() as conn:
+            query = text("SELECT COUNT(*) FROM jwt_records")
+            return conn.execute(query).scalar()
+
+    # All connections, from any thread, share the same database
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        assert executor.submit(count_records).result() == 0
+    engine.dispose()
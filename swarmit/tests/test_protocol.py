@@ -0,0 +1,142 @@
+import dataclasses
+import struct
+from dataclasses import dataclass
+
+import pytest
+from dotbot_utils.protocol import (
+    PAYLOAD_PARSERS,
+    Packet,
+    Payload,
+    PayloadFieldMetadata,
+)
+
+from swarmit.testbed.protocol import (
+    PARSER_TABLE,
+    PayloadEvent,
+    PayloadMessage,
+    PayloadOTAChunk,
+    PayloadOTAChunkAck,
+    PayloadOTAStart,
+    PayloadOTAStartAck,
+    PayloadReset,
+    PayloadStart,
+    PayloadStatus,
+    PayloadStop,
+    PayloadType,
+    StructPayload,
+)
+
+
+def test_payload_status():
+    payload = PayloadStatus(
+        device=1, status=2, battery=3000, pos_x=-1500, pos_y=2000
+    )
+    expected = Payload.to_bytes(payload)
+    assert payload.to_bytes() == expected
+    assert payload.to_bytes("big") == Payload.to_bytes(payload, "big")
+    assert PayloadStatus().from_bytes(expected) == payload
+
+    packet = Packet.from_bytes(Packet.from_payload(payload).to_bytes())
+    assert packet.payload_type == PayloadType.SWARMIT_STATUS
+    assert packet.payload == payload
+
+    with pytest.raises(ValueError, match="Not enough bytes to parse"):
+        PayloadStatus().from_bytes(expected[:-1])
+
+
+def test_payload_ota_chunk():
+    payload = PayloadOTAChunk(
+        index=42, count=5, sha=b"\x01" * 8, chunk=b"\x02" * 5
+    )
+    expected = Payload.to_bytes(payload)
+    assert payload.to_bytes() == expected
+    assert PayloadOTAChunk().from_bytes(expected) == payload
+
+    packet = Packet.from_bytes(Packet.from_payload(payload).to_bytes())
+    assert packet.payload_type == PayloadType.SWARMIT_OTA_CHUNK
+    assert packet.payload == payload
+
+    with pytest.raises(ValueError, match="Not enough bytes to parse"):
+        PayloadOTAChunk().from_bytes(expected[:4])
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        PayloadStart(),
+        PayloadStop(),
+        PayloadReset(pos_x=1500, pos_y=2000),
+        PayloadOTAStart(fw_length=2**16, fw_chunk_count=512),
+        PayloadOTAStartAck(),
+        PayloadOTAChunkAck(index=12),
+        PayloadEvent(timestamp=1234, count=4, data=b"test"),
+        PayloadMessage(count=5, message=b"hello"),
+    ],
+)
+def test_payload_struct(payload):
+    expected = Payload.to_bytes(payload)
+    assert payload.to_bytes() == expected
+    assert payload.__class__().from_bytes(expected) == payload
+
+
+def test_payload_struct_out_of_range():
+    with pytest.raises(OverflowError, match="'pos_x'"):
+        PayloadReset(pos_x=-1).to_bytes()
+
+
+def test_payload_struct_wrong_length():
+    with pytest.raises(ValueError, match="'sha' must be 8 bytes long"):
+        PayloadOTAChunk(sha=b"\x01" * 4).to_bytes()
+
+
+def test_payload_struct_wrong_type():
+    # Only out of range values are reported as OverflowError
+    with pytest.raises(struct.error):
+        PayloadOTAChunk(sha="abcdefgh").to_bytes()
+
+
+def test_payload_metadata_shared():
+    assert PayloadStatus().metadata is PayloadStatus().metadata
+    assert isinstance(PayloadStatus().metadata, tuple)
+    assert PayloadStatus().size == 12
+
+
+def test_payload_slots():
+    assert PayloadOTAChunk.__slots__ == (
+        "metadata",
+        "index",
+        "count",
+        "sha",
+        "chunk",
+    )
+    assert PayloadStart.__slots__ == ()
+
+
+def test_parser_table():
+    assert len(PARSER_TABLE) == 256
+    for payload_type, parser in PAYLOAD_PARSERS.items():
+        assert PARSER_TABLE[payload_type] is parser
+    assert PARSER_TABLE[PayloadType.SWARMIT_STATUS] is PayloadStatus
+    assert PARSER_TABLE[0xFF] is None
+
+
+def test_struct_payload_subclass():
+    @dataclass(slots=True)
+    class PayloadTest(StructPayload):
+        metadata: tuple[PayloadFieldMetadata, ...] = dataclasses.field(
+            default_factory=lambda: (
+                PayloadFieldMetadata(name="value", length=2, signed=True),
+                PayloadFieldMetadata(name="data", type_=bytes, length=0),
+            )
+        )
+
+        value: int = 0
+        data: bytes = dataclasses.field(default_factory=lambda: bytearray)
+
+    # The layout is compiled when the class is created
+    assert PayloadTest._STRUCT.format == "<h"
+    assert PayloadTest._FIELDS == ("value",)
+    assert PayloadTest._TRAILING == "data"
+    payload = PayloadTest(value=-2, data=b"abc")
+    assert payload.to_bytes() == Payload.to_bytes(payload)
+    assert PayloadTest().from_bytes(payload.to_bytes()) == payload
@@ -1,78 +1,134 @@
 import base64
+import contextlib
 import datetime
+import io
+import os
+import time
+from unittest.mock import MagicMock
 
+import jwt
 import pytest
+from dotbot_utils.protocol import Packet
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from fastapi.testclient import TestClient
+from marilib.mari_protocol import Header
 
-from swarmit.testbed.controller import ControllerSettings
-from swarmit.testbed.protocol import StatusType
-from swarmit.testbed.webserver import api, init_api, mount_frontend
+from swarmit.testbed import webserver
+from swarmit.testbed.controller import (
+    Controller,
+    ControllerSettings,
+    NodeStatus,
+)
+from swarmit.testbed.model import JWTRecord
+from swarmit.testbed.protocol import PayloadStatus, StatusType
+from swarmit.testbed.webserver import (
+    FastJSONResponse,
+    _read_key,
+    api,
+    init_api,
+    mount_frontend,
+)
 from swarmit.tests.utils import (
     MarilibSerialAdapterMock,
-    SwarmitNode,
+    add_nodes,
+    wait_until,
 )
 
+# Keep the module on one worker so the app fixture is only set up once
+pytestmark = pytest.mark.xdist_group(name="webserver")
 
-def public_key_not_found():
-    raise FileNotFoundError("public.pem not found")
+AUTH_HEADERS = {"Authorization": "Bearer FAKE_TOKEN"}
+FW_HELLO_B64 = base64.b64encode(b"hello").decode()
+FW_ABC_B64 = base64.b64encode(b"abc").decode()
 
 
-@pytest.fixture
-def client(monkeypatch, tmp_path, capsys):
+def future_start_time(minutes=10):
+    return (
+        datetime.datetime.now(datetime.timezone.utc)
+        + datetime.timedelta(minutes=minutes)
+    ).isoformat()
+
+
+NODE_STATUSES = {
+    0x01: StatusType.Bootloader,
+    0x02: StatusType.Bootloader,
+    0x03: StatusType.Running,
+}
+
+
+@pytest.fixture(scope="module")
+def data_dir(tmp_path_factory):
+    return tmp_path_factory.mktemp("data")
+
+
+@pytest.fixture(scope="module")
+def app_client(data_dir):
+    """Start the API once for the module, with its controller and nodes."""
+
     def fake_jwt_encode(*args, **kwargs):
         return "FAKE_TOKEN"
 
     def fake_jwt_decode(*args, **kwargs):
         return {"user": "ok"}
 
-    monkeypatch.setattr("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.3)
-    monkeypatch.setattr("swarmit.testbed.controller.INACTIVE_TIMEOUT", 0.3)
-    monkeypatch.setattr("swarmit.testbed.controller.STATUS_TIMEOUT", 0.3)
-    monkeypatch.setattr(
-        "swarmit.testbed.controller.COMMAND_ATTEMPT_DELAY", 0.3
-    )
-    monkeypatch.setattr(
-        "swarmit.testbed.webserver.jwt.encode", fake_jwt_encode
-    )
-    monkeypatch.setattr(
-        "swarmit.testbed.webserver.jwt.decode", fake_jwt_decode
-    )
-    monkeypatch.setattr(
-        "swarmit.testbed.adapter.MarilibSerialAdapter",
-        MarilibSerialAdapterMock,
-    )
-    monkeypatch.setattr("swarmit.testbed.webserver.DATA_DIR", f"{tmp_path}")
-    monkeypatch.setattr(
-        "swarmit.testbed.webserver.API_DB_URL",
-        f"sqlite:///{tmp_path}/database.db",
-    )
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr("swarmit.testbed.controller.COMMAND_TIMEOUT", 0.01)
+        mp.setattr("swarmit.testbed.controller.STATUS_TIMEOUT", 0.01)
+        mp.setattr("swarmit.testbed.controller.COMMAND_ATTEMPT_DELAY", 0.01)
+        mp.setattr("swarmit.testbed.webserver.jwt.encode", fake_jwt_encode)
+        mp.setattr("swarmit.testbed.webserver.jwt.decode", fake_jwt_decode)
+        mp.setattr(
+            "swarmit.testbed.adapter.MarilibSerialAdapter",
+            MarilibSerialAdapterMock,
+        )
+        mp.setattr("swarmit.testbed.webserver.DATA_DIR", f"{data_dir}")
+        mp.setattr("swarmit.testbed.webserver.API_DB_URL", "sqlite://")
+
+        (data_dir / "public.pem").write_text("PUBLIC_KEY")
+        (data_dir / "private.pem").write_text("PRIVATE_KEY")
+
+        # Drop the adapter and missing frontend notices printed on setup
+        with contextlib.redirect_stdout(io.StringIO()):
+            controller = init_api(
+                api,
+                ControllerSettings(
+                    network_id=999, adapter="edge", adapter_wait_timeout=0.1
+                ),
+            )
+            mount_frontend(api)
+
+        add_nodes(
+            controller,
+            list(NODE_STATUSES),
+            statuses=list(NODE_STATUSES.values()),
+        )
+
+        with TestClient(api) as c:
+            yield c
 
-    public_key_path = tmp_path / "public.pem"
-    private_key_path = tmp_path / "private.pem"
-    public_key_path.write_text("PUBLIC_KEY")
-    private_key_path.write_text("PRIVATE_KEY")
 
-    controller = init_api(
-        api,
-        ControllerSettings(
-            network_id=999, adapter="edge", adapter_wait_timeout=0.1
-        ),
-    )
-    mount_frontend(api)
-    capsys.readouterr()  # clear init_api output
-
-    test_adapter = controller.interface.mari.serial_interface
-    node1 = SwarmitNode(address=0x01, adapter=test_adapter)
-    node2 = SwarmitNode(address=0x02, adapter=test_adapter)
-    node3 = SwarmitNode(
-        address=0x03, status=StatusType.Running, adapter=test_adapter
+@pytest.fixture
+def client(app_client):
+    """Shared client, with the state changed by the test reset afterwards."""
+    state = app_client.app.state
+    state.verified_tokens.clear()
+    yield app_client
+
+    controller = state.controller
+    adapter = controller.interface.mari.serial_interface
+    for node in adapter.nodes.values():
+        node.reset(NODE_STATUSES[node.address])
+    # Drop the devices added by the test, the nodes just reported
+    controller.cleanup_inactive(1)
+    wait_until(
+        lambda: controller.ready_devices == ["00000001", "00000002"]
+        and controller.running_devices == ["00000003"]
     )
-    nodes = [node1, node2, node3]
-    for node in nodes:
-        test_adapter.add_node(node)
-
-    with TestClient(api) as c:
-        yield c
+    state.status_cache = (None, b"")
+    with webserver.SessionLocal() as db:
+        db.query(JWTRecord).delete()
+        db.commit()
 
 
 def test_status_endpoint(client):
@@ -81,7 +137,76 @@ def test_status_endpoint(client):
     assert "response" in res.json()
 
 
-def test_settings_endpoint(client):
+def test_status_endpoint_cached(client, monkeypatch):
+    controller = api.state.controller
+    controller.status_data["00000042"] = NodeStatus(battery=3000)
+    controller.status_version += 1
+    res = client.get("/status")
+    assert res.json()["response"]["00000042"] == {
+        "device": "Unknown",
+        "status": "Bootloader",
+        "battery": 3000,
+        "pos_x": 0,
+        "pos_y": 0,
+    }
+
+    # data is only serialized again when the status version changes
+    controller.status_data["00000042"].battery = 2000
+    cached = client.get("/status")
+    assert cached.content == res.content
+    controller.status_version += 1
+    res = client.get("/status")
+    assert res.json()["response"]["00000042"]["battery"] == 2000
+
+    monkeypatch.setattr("swarmit.testbed.webserver.orjson", None)
+    controller.status_version += 1
+    assert client.get("/status").json() == res.json()
+
+
+def test_status_endpoint_cached_identical_beacon(client):
+    controller = api.state.controller
+    res = client.get("/status")
+    cache = client.app.state.status_cache
+    status = controller.status_data["00000001"]
+    controller.on_frame_received(
+        Header(source=0x01),
+        Packet.from_payload(
+            PayloadStatus(
+                device=status.device.value,
+                status=status.status.value,
+                battery=status.battery,
+                pos_x=status.pos_x,
+                pos_y=status.pos_y,
+            )
+        ),
+    )
+    assert controller.status_data["00000001"] is not status
+    # the response serialized for the previous request is reused
+    assert client.get("/status").content == res.content
+    assert client.app.state.status_cache is cache
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_fast_json_response(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr("swarmit.testbed.webserver.orjson", None)
+    response = FastJSONResponse(content={"response": "done"})
+    assert response.body == b'{"response":"done"}'
+    assert response.media_type == "application/json"
+    content = {"response": "Déjà", "battery": 2.5}
+    assert (
+        FastJSONResponse(content=content).body
+        == JSONResponse(content=content).body
+    )
+
+
+def test_fast_json_response_nan(monkeypatch):
+    monkeypatch.setattr("swarmit.testbed.webserver.orjson", None)
+    with pytest.raises(ValueError):
+        FastJSONResponse(content={"battery": float("nan")})
+
+
+def test_settings_endpoint(client, monkeypatch):
     res = client.get("/settings")
     assert res.status_code == 200
     assert res.json() == {
@@ -89,68 +214,137 @@ def test_settings_endpoint(client):
         "area_height": 2500,
         "area_width": 2500,
     }
+    # The response is built once at startup
+    assert client.app.state.settings_response is not None
+    monkeypatch.setattr(client.app.state.controller, "settings", None)
+    assert client.get("/settings").json()["network_id"] == 999
+
+
+def test_sampled_access_log(client, monkeypatch):
+    logger = MagicMock()
+    monkeypatch.setattr("swarmit.testbed.webserver.access_logger", logger)
+    monkeypatch.setattr("swarmit.testbed.webserver.ACCESS_LOG_SAMPLE_RATE", 2)
+    for _ in range(4):
+        assert client.get("/settings").status_code == 200
+    assert logger.info.call_count == 2
+    kwargs = logger.info.call_args.kwargs
+    assert kwargs["method"] == "GET"
+    assert kwargs["path"] == "/settings"
+    assert kwargs["status"] == 200
 
 
 def test_start_endpoint(client):
     res = client.post(
         "/start",
         json={"devices": "00000002"},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
+        headers=AUTH_HEADERS,
     )
     assert res.status_code == 200
     assert res.json() == {"response": "done"}
 
 
-def test_start_no_public_key(client, monkeypatch):
-    monkeypatch.setattr(
-        "swarmit.testbed.webserver.get_public_key", public_key_not_found
-    )
-    res = client.post(
-        "/start",
-        json={"devices": "00000002"},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
-    )
-    assert res.status_code == 500
-    assert "public.pem not found" in res.json()["detail"]
-
-
-def test_start_token_expired(client, monkeypatch):
-    import jwt
-
-    def token_expired(*args, **kwargs):
-        raise jwt.ExpiredSignatureError("Token has expired")
+@pytest.mark.parametrize(
+    "endpoint,payload,decode_error,status_code,detail",
+    [
+        pytest.param(
+            "/start",
+            {"devices": "00000002"},
+            None,
+            500,
+            "public.pem not found",
+            id="start-no-public-key",
+        ),
+        pytest.param(
+            "/stop",
+            {"devices": "00000003"},
+            None,
+            500,
+            "public.pem not found",
+            id="stop-no-public-key",
+        ),
+        pytest.param(
+            "/flash",
+            {"firmware_b64": FW_HELLO_B64, "devices": ["00000001"]},
+            None,
+            500,
+            "public.pem not found",
+            id="flash-no-public-key",
+        ),
+        pytest.param(
+            "/start",
+            {"devices": "00000002"},
+            jwt.ExpiredSignatureError("Token has expired"),
+            401,
+            "Token expired",
+            id="start-token-expired",
+        ),
+        pytest.param(
+            "/start",
+            {"devices": "00000002"},
+            jwt.InvalidTokenError("Invalid token"),
+            401,
+            "Invalid token",
+            id="start-token-invalid",
+        ),
+    ],
+)
+def test_auth_errors(
+    client, monkeypatch, endpoint, payload, decode_error, status_code, detail
+):
+    if decode_error is None:
+        monkeypatch.setattr(
+            "swarmit.testbed.webserver.get_public_key",
+            MagicMock(side_effect=FileNotFoundError("public.pem not found")),
+        )
+    else:
+
+        def jwt_decode(*args, **kwargs):
+            raise decode_error
+
+        monkeypatch.setattr("swarmit.testbed.webserver.jwt.decode", jwt_decode)
+    res = client.post(endpoint, json=payload, headers=AUTH_HEADERS)
+    assert res.status_code == status_code
+    assert detail in res.json()["detail"]
+
+
+def test_verified_token_cached(client, monkeypatch):
+    decoded = []
+
+    def fake_jwt_decode(token, *args, **kwargs):
+        decoded.append(token)
+        return {"exp": time.time() + 60}
+
+    def post(token):
+        return client.post(
+            "/flash",
+            json={"firmware_b64": "***notbase64***"},
+            headers={"Authorization": f"Bearer {token}"},
+        )
 
-    monkeypatch.setattr("swarmit.testbed.webserver.jwt.decode", token_expired)
-    res = client.post(
-        "/start",
-        json={"devices": "00000002"},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
+    monkeypatch.setattr(
+        "swarmit.testbed.webserver.jwt.decode", fake_jwt_decode
     )
-    assert res.status_code == 401
-    assert res.json()["detail"] == "Token expired"
-
+    for _ in range(3):
+        assert post("CACHED_TOKEN").status_code == 400
+    assert decoded == ["CACHED_TOKEN"]
 
-def test_start_token_invalid(client, monkeypatch):
-    import jwt
+    # expired entries are verified again
+    api.state.verified_tokens["CACHED_TOKEN"] = ({}, time.time() - 1)
+    post("CACHED_TOKEN")
+    assert decoded == ["CACHED_TOKEN", "CACHED_TOKEN"]
 
-    def token_invalid(*args, **kwargs):
-        raise jwt.InvalidTokenError("Invalid token")
-
-    monkeypatch.setattr("swarmit.testbed.webserver.jwt.decode", token_invalid)
-    res = client.post(
-        "/start",
-        json={"devices": "00000002"},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
-    )
-    assert res.status_code == 401
-    assert res.json()["detail"] == "Invalid token"
+    # the oldest token is dropped when the cache is full
+    monkeypatch.setattr("swarmit.testbed.webserver.JWT_CACHE_SIZE", 2)
+    for token in ["T1", "T2"]:
+        post(token)
+    assert list(api.state.verified_tokens) == ["T1", "T2"]
 
 
 def test_start_devices_none(client, capsys):
     res = client.post(
         "/start",
         json={"devices": None},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
+        headers=AUTH_HEADERS,
     )
     assert res.status_code == 200
     assert "2 devices to start" in capsys.readouterr().out
@@ -160,7 +354,7 @@ def test_start_devices_not_string(client):
     res = client.post(
         "/start",
         json={"devices": 12345},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
+        headers=AUTH_HEADERS,
     )
     assert res.status_code == 422
     assert (
@@ -173,7 +367,7 @@ def test_start_devices_not_list_of_strings(client):
     res = client.post(
         "/start",
         json={"devices": [123, "456"]},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
+        headers=AUTH_HEADERS,
     )
     assert res.status_code == 422
     assert (
@@ -186,71 +380,92 @@ def test_stop_endpoint(client):
     res = client.post(
         "/stop",
         json={"devices": ["00000003"]},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
+        headers=AUTH_HEADERS,
     )
     assert res.status_code == 200
     assert res.json() == {"response": "done"}
 
 
-def test_stop_no_public_key(client, monkeypatch):
-    monkeypatch.setattr(
-        "swarmit.testbed.webserver.get_public_key", public_key_not_found
-    )
-    res = client.post(
-        "/stop",
-        json={"devices": "00000003"},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
-    )
-    assert res.status_code == 500
-    assert "public.pem not found" in res.json()["detail"]
-
-
 def test_flash_firmware_success(client):
-    fw = base64.b64encode(b"hello").decode()
     res = client.post(
         "/flash",
-        json={"firmware_b64": fw, "devices": ["00000001"]},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
+        json={"firmware_b64": FW_HELLO_B64, "devices": ["00000001"]},
+        headers=AUTH_HEADERS,
     )
     assert res.status_code == 200
     assert res.json() == {"response": "success"}
 
 
-def test_flash_no_public_key(client, monkeypatch):
+def test_flash_firmware_ota_window(client, monkeypatch):
+    windows = []
+    transfer = Controller.transfer
+
+    def wrapped_transfer(self, fw, devices, ota_window=None):
+        windows.append(ota_window)
+        return transfer(self, fw, devices, ota_window=ota_window)
+
     monkeypatch.setattr(
-        "swarmit.testbed.webserver.get_public_key", public_key_not_found
+        "swarmit.testbed.controller.Controller.transfer", wrapped_transfer
     )
-    fw = base64.b64encode(b"hello").decode()
+    fw = base64.b64encode(b"hello" * 200).decode()
     res = client.post(
         "/flash",
-        json={"firmware_b64": fw, "devices": ["00000001"]},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
+        json={"firmware_b64": fw, "devices": ["00000001"], "ota_window": 4},
+        headers=AUTH_HEADERS,
     )
-    assert res.status_code == 500
-    assert "public.pem not found" in res.json()["detail"]
+    assert res.status_code == 200
+    assert windows == [4]
+
+    res = client.post(
+        "/flash",
+        json={"firmware_b64": fw, "ota_window": 0},
+        headers=AUTH_HEADERS,
+    )
+    assert res.status_code == 422
 
 
 def test_flash_firmware_invalid_base64(client):
     res = client.post(
         "/flash",
         json={"firmware_b64": "***notbase64***"},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
+        headers=AUTH_HEADERS,
     )
     assert res.status_code == 400
     assert "invalid firmware encoding" in res.json()["detail"]
 
 
 def test_flash_when_device_not_ready(client):
-    fw = base64.b64encode(b"abc").decode()
     res = client.post(
         "/flash",
-        json={"firmware_b64": fw, "devices": ["00000003"]},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
+        json={"firmware_b64": FW_ABC_B64, "devices": ["00000003"]},
+        headers=AUTH_HEADERS,
     )
     assert res.status_code == 400
     assert res.json()["detail"] == "no ready devices to flash"
 
 
+def test_flash_only_ready_devices(client, monkeypatch):
+    flashed = []
+
+    def fake_start_ota(self, fw, devices=None):
+        flashed.append(devices)
+        return {"missed": ["00000001"], "acked": []}
+
+    monkeypatch.setattr(
+        "swarmit.testbed.controller.Controller.start_ota", fake_start_ota
+    )
+    res = client.post(
+        "/flash",
+        json={
+            "firmware_b64": FW_ABC_B64,
+            "devices": ["00000003", "00000001", "42"],
+        },
+        headers=AUTH_HEADERS,
+    )
+    assert res.status_code == 400
+    assert flashed == [["00000001"]]
+
+
 def test_flash_missing_start_ota(client, monkeypatch):
     def fake_start_ota(self, fw, devices=None):
         return {"missed": ["00000001"], "acked": []}
@@ -259,11 +474,10 @@ def test_flash_missing_start_ota(client, monkeypatch):
         "swarmit.testbed.controller.Controller.start_ota", fake_start_ota
     )
 
-    fw = base64.b64encode(b"abc").decode()
     res = client.post(
         "/flash",
-        json={"firmware_b64": fw, "devices": ["00000001"]},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
+        json={"firmware_b64": FW_ABC_B64, "devices": ["00000001"]},
+        headers=AUTH_HEADERS,
     )
     assert res.status_code == 400
     assert "acknowledgments are missing" in res.json()["detail"]
@@ -272,7 +486,7 @@ def test_flash_missing_start_ota(client, monkeypatch):
 def test_flash_transfer_failed(client, monkeypatch):
     from swarmit.testbed.controller import TransferDataStatus
 
-    def fake_transfer(self, fw, devices=None):
+    def fake_transfer(self, fw, devices=None, ota_window=None):
         return {
             "00000001": TransferDataStatus(success=False),
         }
@@ -281,21 +495,17 @@ def test_flash_transfer_failed(client, monkeypatch):
         "swarmit.testbed.controller.Controller.transfer", fake_transfer
     )
 
-    fw = base64.b64encode(b"abc").decode()
     res = client.post(
         "/flash",
-        json={"firmware_b64": fw, "devices": ["00000001"]},
-        headers={"Authorization": "Bearer FAKE_TOKEN"},
+        json={"firmware_b64": FW_ABC_B64, "devices": ["00000001"]},
+        headers=AUTH_HEADERS,
     )
     assert res.status_code == 400
     assert res.json()["detail"] == "transfer failed"
 
 
 def test_issue_jwt(client):
-    start_time = (
-        datetime.datetime.now(datetime.timezone.utc)
-        + datetime.timedelta(minutes=10)
-    ).isoformat()
+    start_time = future_start_time()
     res = client.post("/issue_jwt", json={"start": start_time})
     assert res.status_code == 200
     assert "data" in res.json()
@@ -307,10 +517,7 @@ def test_issue_jwt(client):
 
 
 def test_issue_same_jwt_twice(client):
-    start_time = (
-        datetime.datetime.now(datetime.timezone.utc)
-        + datetime.timedelta(minutes=10)
-    ).isoformat()
+    start_time = future_start_time()
     res = client.post("/issue_jwt", json={"start": start_time})
     assert res.status_code == 200
     assert "data" in res.json()
@@ -346,16 +553,69 @@ def test_public_key_success(client):
     assert res.json()["data"] == "PUBLIC_KEY"
 
 
+def test_public_key_cached(client, monkeypatch, tmp_path):
+    # Use a key of its own, the shared one is left untouched
+    public_key_path = tmp_path / "public.pem"
+    public_key_path.write_text("PUBLIC_KEY")
+    monkeypatch.setattr("swarmit.testbed.webserver.DATA_DIR", f"{tmp_path}")
+
+    assert client.get("/public_key").json()["data"] == "PUBLIC_KEY"
+    hits = _read_key.cache_info().hits
+    assert client.get("/public_key").json()["data"] == "PUBLIC_KEY"
+    assert _read_key.cache_info().hits == hits + 1
+
+    # a new key is loaded as soon as the file changes
+    public_key_path.write_text("NEW_PUBLIC_KEY")
+    stat = public_key_path.stat()
+    os.utime(public_key_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert client.get("/public_key").json()["data"] == "NEW_PUBLIC_KEY"
+
+
+def test_verify_jwt_public_key_changed(client, monkeypatch, tmp_path):
+    monkeypatch.setattr("swarmit.testbed.webserver.DATA_DIR", f"{tmp_path}")
+    keys = []
+
+    def fake_jwt_decode(token, key, *args, **kwargs):
+        keys.append(key)
+        return {"exp": time.time() + 60}
+
+    def start():
+        return client.post(
+            "/start", json={"devices": "00000002"}, headers=AUTH_HEADERS
+        ).status_code
+
+    monkeypatch.setattr(
+        "swarmit.testbed.webserver.jwt.decode", fake_jwt_decode
+    )
+    assert start() == 500
+
+    # public.pem created after startup
+    public_key_path = tmp_path / "public.pem"
+    public_key_path.write_text("PUBLIC_KEY")
+    assert start() == 200
+    assert start() == 200
+    assert keys == ["PUBLIC_KEY"]
+
+    # the tokens verified with the previous key are checked again
+    public_key_path.write_text("NEW_PUBLIC_KEY")
+    stat = public_key_path.stat()
+    os.utime(public_key_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert start() == 200
+    assert keys == ["PUBLIC_KEY", "NEW_PUBLIC_KEY"]
+    assert client.get("/public_key").json()["data"] == "NEW_PUBLIC_KEY"
+
+
 def test_public_key_not_found(client, monkeypatch):
     monkeypatch.setattr(
-        "swarmit.testbed.webserver.get_public_key", public_key_not_found
+        "swarmit.testbed.webserver.get_public_key",
+        MagicMock(side_effect=FileNotFoundError("public.pem not found")),
     )
     res = client.get("/public_key")
     assert res.status_code == 500
     assert "public.pem not found" in res.json()["detail"]
 
 
-def test_frontend_not_exists(client, capsys, monkeypatch):
+def test_frontend_not_exists(capsys, monkeypatch):
     monkeypatch.setattr("os.path.isdir", lambda path: False)
-    mount_frontend(client.app)
+    mount_frontend(FastAPI())
     assert "Warning: dashboard directory not found" in capsys.readouterr().out
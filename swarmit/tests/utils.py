@@ -3,6 +3,7 @@ from __future__ import annotations
 import dataclasses
 import threading
 import time
+from typing import Callable, ClassVar
 
 from dotbot_utils.protocol import Packet
 from marilib.mari_protocol import MARI_BROADCAST_ADDRESS, Frame, Header
@@ -19,6 +20,21 @@ from swarmit.testbed.protocol import (
     StatusType,
 )
 
+# Set each time the status of a simulated node changes
+STATUS_CHANGED = threading.Event()
+
+
+def wait_until(predicate, timeout: float = 2.0, interval: float = 0.005):
+    """Wait until predicate() is true, raise TimeoutError after timeout."""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Condition not met after {timeout}s")
+        # Re-check as soon as a node status changes, poll otherwise
+        if STATUS_CHANGED.wait(min(interval, remaining)):
+            STATUS_CHANGED.clear()
+
 
 @dataclasses.dataclass
 class ChunkAckStrategy:
@@ -33,37 +49,37 @@ class ChunkAckStrategy:
     )
 
 
-class LogEventTask(threading.Thread):
-
-    def __init__(
-        self, node: SwarmitNode, message, event_interval: float = 0.5
-    ):
-        self.node = node
-        self.message = message
-        self.event_interval = event_interval
-        self._stop_event = threading.Event()
-        super().__init__(daemon=True)
-
-    def run(self):
-        time.sleep(0.05)  # allow some time for initialization
-        while not self._stop_event.is_set():
-            self.node.send_packet(
-                Packet().from_payload(
-                    PayloadEvent(
-                        timestamp=int(time.time()),
-                        count=len(self.message),
-                        data=self.message.encode(),
-                    ),
-                )
-            )
-            time.sleep(self.event_interval)
-
-    def stop(self):
-        self._stop_event.set()
-        self.join()
-
+@dataclasses.dataclass(slots=True)
+class OTAState:
+    """OTA transfer state of a simulated node."""
 
-class SwarmitNode(threading.Thread):
+    ack_strategy: ChunkAckStrategy = dataclasses.field(
+        default_factory=ChunkAckStrategy
+    )
+    should_fail: bool = False
+    total_chunks: int = 0
+    last_chunk_acked: int = -1
+    bytes_received: int = 0
+    expected_bytes: int = 0
+
+
+class SwarmitNode:
+    """Simulated node, reports its status each time it changes."""
+
+    __slots__ = (
+        "adapter",
+        "address",
+        "device_type",
+        "_status",
+        "battery",
+        "enabled",
+        "ota",
+        "_ack_strategy",
+        "log_message",
+        "frame_header",
+        "_data_prefix",
+        "_chunk_ack",
+    )
 
     def __init__(
         self,
@@ -72,128 +88,177 @@ class SwarmitNode(threading.Thread):
         status: StatusType = StatusType.Bootloader,
         device_type: DeviceType = DeviceType.Unknown,
         battery: int = 2500,
-        update_interval: float = 0.1,
-        ack_strategy: ChunkAckStrategy = ChunkAckStrategy(),
+        ack_strategy: ChunkAckStrategy | None = None,
         ota_should_fail: bool = False,
     ):
         self.adapter = adapter
         self.address = address
         self.device_type = device_type
-        self.status = status
+        # Not reported yet, the adapter emits the status once joined
+        self._status = status
         self.battery = battery
-        self.update_interval = update_interval
-        self.ack_strategy = ack_strategy
-        self.ota_should_fail = ota_should_fail
-        self._stop_event = threading.Event()
-        super().__init__(daemon=True)
         self.enabled = True
-        self.total_chunks = 0
-        self.last_chunk_acked = -1
-        self.ota_bytes_received = 0
-        self.ota_expected_bytes_received = 0
-        self.start()
-        self.log_event_task = LogEventTask(
-            self,
-            message=f"Node {self.address:08X} log event",
+        # The strategy is consumed by the transfer, reset() starts from a
+        # fresh copy of the configured one
+        self._ack_strategy = ack_strategy or ChunkAckStrategy()
+        self.ota = OTAState(
+            ack_strategy=dataclasses.replace(self._ack_strategy),
+            should_fail=ota_should_fail,
         )
+        self.log_message = f"Node {self.address:08X} log event"
+        # The MAC header of the frames sent by the node never changes
+        self.frame_header = Header(
+            destination=0, source=self.address, type_=PacketType.DATA
+        ).to_bytes()
+        self._data_prefix = (
+            EdgeEvent.to_bytes(EdgeEvent.NODE_DATA) + self.frame_header
+        )
+        # Reused for each chunk ack, it is serialized as soon as it is sent
+        self._chunk_ack = Packet().from_payload(PayloadOTAChunkAck())
 
-    def run(self):
-        while not self._stop_event.is_set():
-            if self.enabled:
-                packet = Packet().from_payload(
-                    PayloadStatus(
-                        device=self.device_type.value,
-                        status=self.status.value,
-                        battery=self.battery,
-                        pos_x=2500,
-                        pos_y=2500,
-                    ),
-                )
-                self.send_packet(packet)
-            time.sleep(self.update_interval)
-
-    def stop(self):
-        if self.log_event_task.is_alive():
-            self.log_event_task.stop()
-        self._stop_event.set()
-        self.join()
-
-    def start_log_event_task(self):
-        self.log_event_task.start()
+    @property
+    def status(self) -> StatusType:
+        return self._status
 
-    def handle_frame(self, frame: Frame):
-        if (
-            frame.header.destination != self.address
-            and frame.header.destination != MARI_BROADCAST_ADDRESS
-        ):
+    @status.setter
+    def status(self, value: StatusType):
+        self._status = value
+        self.emit_status()
+        STATUS_CHANGED.set()
+
+    def reset(self, status: StatusType = StatusType.Bootloader):
+        """Bring a node reused across tests back to its initial state."""
+        self.enabled = True
+        self.ota = OTAState(
+            ack_strategy=dataclasses.replace(self._ack_strategy),
+            should_fail=self.ota.should_fail,
+        )
+        self.status = status
+
+    def emit_status(self):
+        if not self.enabled:
             return
-        packet = Packet.from_bytes(frame.payload)
-        payload_type = PayloadType(packet.payload_type)
-        if payload_type == PayloadType.SWARMIT_START:
-            self.status = StatusType.Running
-        elif payload_type == PayloadType.SWARMIT_STOP:
-            self.status = StatusType.Bootloader
-        elif payload_type == PayloadType.SWARMIT_RESET:
-            self.status = StatusType.Resetting
-        elif payload_type == PayloadType.SWARMIT_MESSAGE:
-            print(
-                f"Node {self.address:08X} received message: {packet.payload.message.decode()}"
-            )
-        elif payload_type == PayloadType.SWARMIT_OTA_START:
-            self.status = StatusType.Programming
-            self.total_chunks = packet.payload.fw_chunk_count
-            self.ota_expected_bytes_received = packet.payload.fw_length
-            self.send_packet(Packet().from_payload(PayloadOTAStartAck()))
-        elif payload_type == PayloadType.SWARMIT_OTA_CHUNK:
-            # ack miss simulation
-            if self.ack_strategy.ack_miss_index == packet.payload.index:
-                if self.ack_strategy.ack_miss_retries > 0:
-                    self.ack_strategy.ack_miss_retries -= 1
-                    return
-
-            # only log index if not already acknowledged
-            if self.last_chunk_acked != packet.payload.index:
-                self.last_chunk_acked = packet.payload.index
-                self.ota_bytes_received += packet.payload.count
-
-            index_to_ack = packet.payload.index
-            if (
-                self.ack_strategy.ack_out_of_range_index
-                == packet.payload.index
-            ):
-                index_to_ack = self.total_chunks + 1
-            self.send_packet(
-                Packet().from_payload(PayloadOTAChunkAck(index=index_to_ack))
+        packet = Packet().from_payload(
+            PayloadStatus(
+                device=self.device_type.value,
+                status=self.status.value,
+                battery=self.battery,
+                pos_x=2500,
+                pos_y=2500,
+            ),
+        )
+        self.send_packet(packet)
+
+    def emit_log_event(self):
+        self.send_packet(
+            Packet().from_payload(
+                PayloadEvent(
+                    timestamp=int(time.time()),
+                    count=len(self.log_message),
+                    data=self.log_message.encode(),
+                ),
             )
-            if (
-                index_to_ack == self.total_chunks - 1
-                and not self.ota_should_fail
-            ):
-                assert (
-                    self.ota_bytes_received == self.ota_expected_bytes_received
-                )
-                self.status = StatusType.Bootloader
+        )
+
+    def _on_start(self, packet: Packet):
+        self.status = StatusType.Running
+
+    def _on_stop(self, packet: Packet):
+        self.status = StatusType.Bootloader
+
+    def _on_reset(self, packet: Packet):
+        self.status = StatusType.Resetting
+
+    def _on_message(self, packet: Packet):
+        print(
+            f"Node {self.address:08X} received message: {packet.payload.message.decode()}"
+        )
+
+    def _on_ota_start(self, packet: Packet):
+        self.status = StatusType.Programming
+        self.ota.total_chunks = packet.payload.fw_chunk_count
+        self.ota.expected_bytes = packet.payload.fw_length
+        self.send_packet(Packet().from_payload(PayloadOTAStartAck()))
+
+    def _on_ota_chunk(self, packet: Packet):
+        ota = self.ota
+        index = packet.payload.index
+        # ack miss simulation
+        if ota.ack_strategy.ack_miss_index == index:
+            if ota.ack_strategy.ack_miss_retries > 0:
+                ota.ack_strategy.ack_miss_retries -= 1
+                return
+
+        # only log index if not already acknowledged
+        if ota.last_chunk_acked != index:
+            ota.last_chunk_acked = index
+            ota.bytes_received += packet.payload.count
+
+        index_to_ack = index
+        if ota.ack_strategy.ack_out_of_range_index == index:
+            index_to_ack = ota.total_chunks + 1
+        self._chunk_ack.payload.index = index_to_ack
+        self.send_packet(self._chunk_ack)
+        if index_to_ack == ota.total_chunks - 1 and not ota.should_fail:
+            assert ota.bytes_received == ota.expected_bytes
+            self.status = StatusType.Bootloader
+
+    _HANDLERS: ClassVar[dict[int, Callable[[SwarmitNode, Packet], None]]] = {
+        PayloadType.SWARMIT_START: _on_start,
+        PayloadType.SWARMIT_STOP: _on_stop,
+        PayloadType.SWARMIT_RESET: _on_reset,
+        PayloadType.SWARMIT_MESSAGE: _on_message,
+        PayloadType.SWARMIT_OTA_START: _on_ota_start,
+        PayloadType.SWARMIT_OTA_CHUNK: _on_ota_chunk,
+    }
+
+    def handle_frame(self, frame: Frame):
+        # The adapter only hands over the frames sent to the node
+        packet = Packet.from_bytes(frame.payload)
+        handler = self._HANDLERS.get(packet.payload_type)
+        if handler is not None:
+            handler(self, packet)
 
     def send_packet(self, packet: Packet):
         self.adapter.handle_data_received(
-            EdgeEvent.to_bytes(EdgeEvent.NODE_DATA)
-            + Frame(
-                header=Header(
-                    destination=0, source=self.address, type_=PacketType.DATA
-                ),
-                payload=packet.to_bytes(),
-            ).to_bytes()
+            self._data_prefix + packet.to_bytes()
         )
 
 
+def add_nodes(controller, addresses, *, statuses=None, **kwargs):
+    """Attach simulated nodes to the mock adapter of a controller."""
+    if controller.settings.adapter == "cloud":
+        adapter = controller.interface.mari.mqtt_interface
+    else:
+        adapter = controller.interface.mari.serial_interface
+    if statuses is None:
+        statuses = [StatusType.Bootloader] * len(addresses)
+    nodes = [
+        SwarmitNode(adapter, address, status=status, **kwargs)
+        for address, status in zip(addresses, statuses)
+    ]
+    for node in nodes:
+        adapter.add_node(node)
+    return adapter, nodes
+
+
 class MarilibAdapterMockBase:
 
     nodes: dict[int, SwarmitNode]
 
     def send_data(self, data: bytes):
         """Send data to the interface."""
-        for node in self.nodes.values():
-            node.handle_frame(Frame().from_bytes(data[1:]))
+        # Skip the edge event byte without copying the rest of the buffer
+        frame = Frame().from_bytes(memoryview(data)[1:])
+        destination = frame.header.destination
+        if destination == MARI_BROADCAST_ADDRESS:
+            nodes = list(self.nodes.values())
+        elif destination in self.nodes:
+            nodes = [self.nodes[destination]]
+        else:
+            return
+        for node in nodes:
+            node.handle_frame(frame)
 
 
 class MarilibSerialAdapterMock(MarilibAdapterMockBase):
@@ -209,29 +274,17 @@ class MarilibSerialAdapterMock(MarilibAdapterMockBase):
 
     def add_node(self, node: SwarmitNode):
         self.nodes[node.address] = node
-        frame = Frame(
-            header=Header(
-                destination=0, source=node.address, type_=PacketType.DATA
-            ),
-            payload=b"",
-        )
         self.handle_data_received(
-            EdgeEvent.to_bytes(EdgeEvent.NODE_JOINED) + frame.to_bytes()
+            EdgeEvent.to_bytes(EdgeEvent.NODE_JOINED) + node.frame_header
         )
+        node.emit_status()
 
     def close(self):
         """Close the interface."""
         for node in self.nodes.values():
-            frame = Frame(
-                header=Header(
-                    destination=0, source=node.address, type_=PacketType.DATA
-                ),
-                payload=b"",
-            )
             self.handle_data_received(
-                EdgeEvent.to_bytes(EdgeEvent.NODE_LEFT) + frame.to_bytes()
+                EdgeEvent.to_bytes(EdgeEvent.NODE_LEFT) + node.frame_header
             )
-            node.stop()
         self.nodes = {}
 
 
@@ -263,6 +316,7 @@ class MarilibMQTTAdapterMock(MarilibAdapterMockBase):
         self.handle_data_received(
             EdgeEvent.to_bytes(EdgeEvent.NODE_JOINED) + frame.to_bytes()
         )
+        node.emit_status()
 
     def send_data_to_edge(self, data):
         self.send_data(data)
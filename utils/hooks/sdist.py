@@ -2,30 +2,88 @@
 
 # pylint: disable=too-few-public-methods
 
+import hashlib
 import os
-import shlex
 import subprocess
 import sys
 
 from hatchling.builders.hooks.plugin.interface import BuildHookInterface
 
-NPM_INSTALL_CMD = "npm install --no-progress"
-NPM_BUILD_CMD = "npm run build"
+NPM_INSTALL_CMD = ["npm", "ci", "--no-audit", "--no-fund", "--no-progress"]
+NPM_BUILD_CMD = ["npm", "run", "build"]
+# Reuse the local npm cache and skip the registry metadata requests
+NPM_ENV = {
+    "NPM_CONFIG_PREFER_OFFLINE": "true",
+    "NPM_CONFIG_AUDIT": "false",
+    "NPM_CONFIG_FUND": "false",
+}
+BUILD_DIR = "build"
+BUILD_HASH_FILE = ".build_hash"
+# Files and directories of the frontend that the build output depends on
+BUILD_SOURCES = [
+    "index.html",
+    "package.json",
+    "package-lock.json",
+    "postcss.config.js",
+    "tailwind.config.js",
+    "tsconfig.json",
+    "vite.config.js",
+    "public",
+    "src",
+]
+
+
+def sources_hash(frontend_dir):
+    """Returns a hash of the frontend build sources."""
+    paths = []
+    for source in BUILD_SOURCES:
+        path = os.path.join(frontend_dir, source)
+        if os.path.isfile(path):
+            paths.append(path)
+        for dirpath, _, filenames in os.walk(path):
+            paths.extend(os.path.join(dirpath, name) for name in filenames)
+    digest = hashlib.blake2b()
+    for path in sorted(paths):
+        digest.update(os.path.relpath(path, frontend_dir).encode())
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def read_build_hash(path):
+    """Returns the sources hash of the last build, if any."""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
 
 
 def build_frontend(root):
-    """Builds the ReactJS frontend."""
+    """Builds the ReactJS frontend, unless its sources didn't change."""
     frontend_dir = os.path.join(root, "swarmit", "dashboard", "frontend")
     os.makedirs(os.path.join(frontend_dir, "dist"), exist_ok=True)
 
-    if sys.platform != "win32":
-        print("Building React frontend application...")
-        subprocess.run(
-            shlex.split(NPM_INSTALL_CMD), cwd=frontend_dir, check=True
-        )
-        subprocess.run(
-            shlex.split(NPM_BUILD_CMD), cwd=frontend_dir, check=True
-        )
+    if sys.platform == "win32":
+        return
+
+    build_dir = os.path.join(frontend_dir, BUILD_DIR)
+    hash_path = os.path.join(build_dir, BUILD_HASH_FILE)
+    current_hash = sources_hash(frontend_dir)
+    if (
+        os.path.isfile(os.path.join(build_dir, "index.html"))
+        and read_build_hash(hash_path) == current_hash
+    ):
+        print("React frontend application is up to date")
+        return
+
+    print("Building React frontend application...")
+    env = {**os.environ, **NPM_ENV}
+    subprocess.run(NPM_INSTALL_CMD, cwd=frontend_dir, env=env, check=True)
+    subprocess.run(NPM_BUILD_CMD, cwd=frontend_dir, env=env, check=True)
+    # Written last, the build empties its output directory first
+    with open(hash_path, "w") as f:
+        f.write(current_hash)
 
 
 class CustomBuildHook(BuildHookInterface):